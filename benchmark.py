@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+
+# Offline benchmarks for edgalmap and update_named_systems.py, so that we can
+# tell whether a change makes things faster or slower. Results are written as
+# JSON, and a previous results file can be passed to --compare to flag any
+# regressions.
+
+import argparse
+import gzip
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+import edgalmap
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+
+# Sector used to generate procedural names / addresses, any will do
+benchmark_sector = 'Wregoe'
+
+def best_of(fn, repeat=5):
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def random_system(rng, cube_layer, sector=benchmark_sector):
+    # Returns (procedural prefix, cube layer, boxel remainder, system id) for
+    # a random system in the given layer of the given sector
+    boxel_bits = 7 - cube_layer
+    boxel_key = 0
+    for i in range(3):
+        boxel_key |= rng.randrange(1 << boxel_bits) << (i * 7)
+    letters = ''.join(chr(ord('A') + boxel_key // 26**i % 26) for i in range(3))
+    prefix = '%s %s-%s' % (sector, letters[:2], letters[2])
+    return (prefix, cube_layer, boxel_key // 26**3, rng.randrange(1 << (11 + 3 * cube_layer)))
+
+def random_system_addresses(rng, cube_layer, count):
+    return [edgalmap.encode_system_address(*random_system(rng, cube_layer)) for i in range(count)]
+
+def run_python(code, cwd=script_dir):
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-c', code], cwd=cwd, check=True, stdout=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+def bench_startup(repeat):
+    results = {}
+    # Interpreter startup on its own, to separate it from our own costs
+    results['python_s'] = min(run_python('pass') for i in range(repeat))
+    results['import_s'] = min(run_python('import edgalmap') for i in range(repeat))
+    results['first_address_lookup_s'] = min(run_python(
+        'import edgalmap; edgalmap.resolve_system_address(10477373803)') for i in range(repeat))
+    results['first_name_lookup_s'] = min(run_python(
+        'import edgalmap; edgalmap.resolve("Sol", log=edgalmap.quiet)') for i in range(repeat))
+    return results
+
+def bench_codec(count, repeat):
+    rng = random.Random(0)
+    results = {}
+    for cube_layer in range(8):
+        systems = [random_system(rng, cube_layer) for i in range(count)]
+        addresses = [edgalmap.encode_system_address(*x) for x in systems]
+        def resolve():
+            for address in addresses:
+                edgalmap.resolve_system_address(address)
+        def encode():
+            for system in systems:
+                edgalmap.encode_system_address(*system)
+        layer = chr(ord('a') + cube_layer)
+        results['resolve_per_s_%s' % layer] = count / best_of(resolve, repeat)
+        results['encode_per_s_%s' % layer] = count / best_of(encode, repeat)
+    return results
+
+def bench_names(count, repeat):
+    rng = random.Random(0)
+    index = edgalmap.Galaxy().named_systems_index
+    unique = [v[0][0] for v in index.values() if len(v) == 1]
+    dupes = [v[0][0] for v in index.values() if len(v) > 1]
+    procedural = [edgalmap.resolve_system_address(a)[0] for a in random_system_addresses(rng, 3, count)]
+    results = {}
+    # s_by_name minus the clipboard, which would dominate and spam the user
+    for kind, names in (('procedural', procedural), ('unique_named', unique), ('duplicate_named', dupes)):
+        names = [rng.choice(names) for i in range(count)]
+        def lookup():
+            for name in names:
+                try:
+                    edgalmap.resolve(name, log=edgalmap.quiet)
+                except (edgalmap.AmbiguousSystemName, KeyError):
+                    pass
+        results['%s_per_s' % kind] = count / best_of(lookup, repeat)
+    return results
+
+def write_synthetic_dump(filename, systems, named_every=50, seed=0):
+    '''
+    Write a dump in the same format as Spansh's systems.json.gz, with every
+    named_every'th system given a custom name and the rest procedural names
+    that match their id64.
+    '''
+    rng = random.Random(seed)
+    with gzip.open(filename, 'wt', compresslevel=1) as f:
+        f.write('[\n')
+        for i in range(systems):
+            cube_layer = rng.randrange(8)
+            id64 = edgalmap.encode_system_address(*random_system(rng, cube_layer))
+            if i % named_every == 0:
+                name = 'Synthetic %i' % i
+            else:
+                name = edgalmap.resolve_system_address(id64)[0]
+            f.write(json.dumps({
+                'id64': id64,
+                'name': name,
+                'mainStar': 'M (Red dwarf) Star',
+                'coords': {'x': rng.uniform(-40000, 40000), 'y': rng.uniform(-2000, 2000), 'z': rng.uniform(-20000, 60000)},
+                'updateTime': '2024-01-01 00:00:00+00',
+            }, separators=(',', ':')))
+            f.write(',\n' if i < systems - 1 else '\n')
+        f.write(']\n')
+
+def bench_dump(systems, jobs):
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        dump = os.path.join(tmp_dir, 'systems.json.gz')
+        write_synthetic_dump(dump, systems)
+        results['dump_bytes'] = os.stat(dump).st_size
+        args = [sys.executable, os.path.join(script_dir, 'update_named_systems.py'), dump]
+        if jobs:
+            args[2:2] = ['-j', str(jobs)]
+        start = time.perf_counter()
+        subprocess.run(args, cwd=tmp_dir, check=True, stdout=subprocess.DEVNULL)
+        elapsed = time.perf_counter() - start
+    results['update_named_systems_s'] = elapsed
+    results['update_named_systems_lines_per_s'] = systems / elapsed
+    results['update_named_systems_bytes_per_s'] = results['dump_bytes'] / elapsed
+    return results
+
+def compare(results, baseline, threshold):
+    # Anything measured in seconds should go down, everything else is a rate
+    # that should go up
+    regressions = 0
+    for group, values in results['results'].items():
+        for name, value in values.items():
+            old = baseline['results'].get(group, {}).get(name)
+            if not old or name == 'dump_bytes':
+                continue
+            if '_per_s' in name:
+                change = old / value
+            else:
+                change = value / old
+            flag = ''
+            if change > 1 + threshold:
+                flag = ' REGRESSION'
+                regressions += 1
+            print('%s.%s: %.4g -> %.4g (%+.1f%% time)%s' % (group, name, old, value, (change - 1) * 100, flag))
+    return regressions
+
+all_benchmarks = ['startup', 'codec', 'names', 'dump']
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark edgalmap')
+    parser.add_argument('-o', '--output', metavar='FILE', help='Write results as JSON to FILE instead of stdout')
+    parser.add_argument('-c', '--compare', metavar='FILE', help='Compare against a previous results file')
+    parser.add_argument('--threshold', type=float, default=0.1, help='Relative slowdown reported as a regression by --compare (default %(default)s)')
+    parser.add_argument('-n', '--count', type=int, default=10000, help='Lookups per codec / name benchmark (default %(default)s)')
+    parser.add_argument('-r', '--repeat', type=int, default=5, help='Repeats, best time is kept (default %(default)s)')
+    parser.add_argument('--dump-systems', type=int, default=200000, help='Size of the synthetic dump for update_named_systems.py (default %(default)s, 0 to skip)')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='Worker processes for update_named_systems.py')
+    parser.add_argument('--make-dump', metavar='FILE', help='Just write a synthetic Spansh format dump of --dump-systems systems to FILE')
+    parser.add_argument('benchmarks', nargs='*', help='Benchmarks to run: %s (default all)' % ', '.join(all_benchmarks))
+    args = parser.parse_args()
+    for benchmark in args.benchmarks:
+        if benchmark not in all_benchmarks:
+            parser.error('unknown benchmark: %s' % benchmark)
+
+    if args.make_dump:
+        write_synthetic_dump(args.make_dump, args.dump_systems)
+        return 0
+
+    benchmarks = args.benchmarks or all_benchmarks
+    results = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'results': {},
+    }
+    if 'startup' in benchmarks:
+        results['results']['startup'] = bench_startup(args.repeat)
+    if 'codec' in benchmarks:
+        results['results']['codec'] = bench_codec(args.count, args.repeat)
+    if 'names' in benchmarks:
+        results['results']['names'] = bench_names(args.count, args.repeat)
+    if 'dump' in benchmarks and args.dump_systems:
+        results['results']['dump'] = bench_dump(args.dump_systems, args.jobs)
+
+    output = json.dumps(results, indent=1)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.threshold):
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,381 @@
+#!/usr/bin/env python3
+
+# Clipboard backends used to hand galaxy map search strings over to the game:
+#
+#   win32  - Native Windows / Cygwin Python, via winclipboard.py. Queues of
+#            search strings advance automatically as each one is pasted.
+#   helper - A long lived helper process fed one string per line over a pipe,
+#            so that queues don't pay for starting a process on every copy.
+#            Defaults to a PowerShell loop under WSL, or set
+#            $EDGALMAP_CLIPBOARD_HELPER to any command speaking the same
+#            protocol (see serve_helper).
+#   clip   - Runs clip.exe for every copy (WSL).
+#   file   - Writes each string to $EDGALMAP_CLIPBOARD (default
+#            ~/.edgalmap_clipboard) for other tools to pick up. If that is a
+#            FIFO each string is written to it as a line, and dropped when
+#            nothing is reading from it.
+#
+# The backend is picked automatically, or set $EDGALMAP_CLIPBOARD_BACKEND or
+# pass --clipboard to edgalmap.py to choose one. Every backend keeps count of
+# how long its copies take, which is also reported by --profile.
+
+import argparse
+import atexit
+import errno
+import os
+import shlex
+import shutil
+import stat
+import subprocess
+import sys
+import threading
+import time
+
+import profiling
+
+clipboard_file = os.environ.get('EDGALMAP_CLIPBOARD', os.path.expanduser('~/.edgalmap_clipboard'))
+
+# Called with every string copied, once it is in the clipboard (e.g.
+# crash_monitor.record_copy)
+copy_hooks = []
+
+# Reads one line at a time from stdin and puts it in the Windows clipboard,
+# acknowledging each one so the caller knows when it has landed
+powershell_helper = ['powershell.exe', '-NoProfile', '-NonInteractive', '-Command',
+        '$in = [Console]::In; while (($line = $in.ReadLine()) -ne $null) {'
+        ' Set-Clipboard -Value $line; [Console]::Out.WriteLine("ok"); [Console]::Out.Flush() }']
+
+class Latency(object):
+    '''
+    Running count, total, minimum and maximum of the time taken per copy
+    '''
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if self.max is None or seconds > self.max:
+            self.max = seconds
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    def __str__(self):
+        if not self.count:
+            return 'no copies'
+        return '%i copies, mean %.3fms, min %.3fms, max %.3fms' % (self.count,
+                self.mean * 1000.0, self.min * 1000.0, self.max * 1000.0)
+
+class Backend(object):
+    name = None
+
+    def __init__(self):
+        self.latency = Latency()
+
+    def copy(self, text):
+        # text is bytes, as the game only understands ASCII search strings
+        start = time.perf_counter()
+        self._copy(text)
+        elapsed = time.perf_counter() - start
+        self.latency.add(elapsed)
+        profiling.record('clipboard copy (%s)' % self.name, elapsed)
+        run_copy_hooks(text)
+
+    def close(self):
+        pass
+
+    def send_queue(self, blobs, record=None, ui=None):
+        # We can't tell when the clipboard has been pasted without owning it,
+        # so step through the queue on enter instead. Each copy is waited for
+        # before saying it was made, so none is ever skipped.
+        with AsyncClipboard(self) as clip:
+            for (field, blob) in blobs:
+                errors = len(clip.errors)
+                clip.submit(blob)
+                clip.flush()
+                if len(clip.errors) > errors:
+                    print('Stopping, %s for \'%s\' was not copied' % (field, record))
+                    break
+                try:
+                    input('Copied %s for \'%s\' to clipboard, press enter to continue...' % (field, record))
+                except (EOFError, KeyboardInterrupt):
+                    print()
+                    break
+
+class Win32Backend(Backend):
+    name = 'win32'
+
+    def __init__(self):
+        Backend.__init__(self)
+        import winclipboard
+        self.winclipboard = winclipboard
+
+    def _copy(self, text):
+        self.winclipboard.copy_text_simple(text)
+
+    def send_queue(self, blobs, record=None, ui=None):
+        # Owns the clipboard and advances as soon as each blob is pasted,
+        # which is when it takes the next one from blobs
+        def hooked(blobs):
+            for (field, blob) in blobs:
+                run_copy_hooks(blob)
+                yield (field, blob)
+        self.winclipboard.sendViaClipboard(hooked(blobs), record=record, ui=ui or self.winclipboard.ui_null())
+
+class ClipExeBackend(Backend):
+    name = 'clip'
+
+    def _copy(self, text):
+        subprocess.run(['clip.exe'], input=text, check=True)
+
+class HelperBackend(Backend):
+    '''
+    Keeps one helper process running and sends it each string as a line,
+    waiting for its "ok" line in reply.
+    '''
+    name = 'helper'
+
+    def __init__(self, command=None):
+        Backend.__init__(self)
+        self.command = command or helper_command()
+        if self.command is None:
+            raise OSError('No clipboard helper available, set $EDGALMAP_CLIPBOARD_HELPER')
+        self.process = None
+
+    def start(self):
+        self.process = subprocess.Popen(self.command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def _copy(self, text):
+        if b'\n' in text or b'\r' in text:
+            raise ValueError('Clipboard helper can only copy a single line')
+        # Restart the helper once if it has gone away since the last copy
+        for attempt in range(2):
+            if self.process is None or self.process.poll() is not None:
+                self.start()
+            try:
+                self.process.stdin.write(text + b'\n')
+                self.process.stdin.flush()
+                reply = self.process.stdout.readline()
+            except OSError:
+                reply = b''
+            if reply.strip() == b'ok':
+                return
+            if reply:
+                raise OSError('Clipboard helper failed: %s' % reply.decode('utf-8', 'replace').strip())
+            self.close()
+        raise OSError('Clipboard helper exited unexpectedly')
+
+    def close(self):
+        if self.process is None:
+            return
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
+        try:
+            self.process.wait(5)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        self.process.stdout.close()
+        self.process = None
+
+class FileBackend(Backend):
+    name = 'file'
+
+    def __init__(self, filename=None):
+        Backend.__init__(self)
+        self.filename = filename or clipboard_file
+        self.dropped = 0
+
+    def _copy(self, text):
+        try:
+            is_fifo = stat.S_ISFIFO(os.stat(self.filename).st_mode)
+        except OSError:
+            is_fifo = False
+        if not is_fifo:
+            with open(self.filename, 'wb') as f:
+                f.write(text)
+            return
+        try:
+            fd = os.open(self.filename, os.O_WRONLY | os.O_NONBLOCK)
+        except OSError as e:
+            if e.errno != errno.ENXIO:
+                raise
+            # Nobody is listening, don't hang around waiting for them
+            self.dropped += 1
+            return
+        try:
+            os.write(fd, text + b'\n')
+        finally:
+            os.close(fd)
+
+def run_copy_hooks(text):
+    for hook in copy_hooks:
+        hook(text)
+
+backends = {
+    'win32': Win32Backend,
+    'helper': HelperBackend,
+    'clip': ClipExeBackend,
+    'file': FileBackend,
+}
+
+def helper_command():
+    command = os.environ.get('EDGALMAP_CLIPBOARD_HELPER')
+    if command:
+        return shlex.split(command)
+    if shutil.which('powershell.exe'):
+        return powershell_helper
+    return None
+
+_have_win32 = None
+def have_win32():
+    global _have_win32
+    if _have_win32 is None:
+        try:
+            with profiling.phase('import winclipboard'):
+                import winclipboard
+            _have_win32 = True
+        except Exception: # Occurs on WSL and Linux
+            _have_win32 = False
+    return _have_win32
+
+def default_backend_name(persistent=False):
+    # persistent is for callers about to copy a whole queue of strings, where
+    # the startup cost of a helper process pays for itself
+    name = os.environ.get('EDGALMAP_CLIPBOARD_BACKEND')
+    if name:
+        return name
+    if have_win32():
+        return 'win32'
+    if persistent and helper_command():
+        return 'helper'
+    if shutil.which('clip.exe'):
+        return 'clip'
+    return 'file'
+
+def open_backend(name=None, persistent=False):
+    name = name or default_backend_name(persistent)
+    if name not in backends:
+        raise ValueError('Unknown clipboard backend: %s (choose from %s)' % (name, ', '.join(sorted(backends))))
+    return backends[name]()
+
+_backends = {}
+backend_name = None
+
+def get_backend(persistent=False):
+    '''
+    Shared backend for this process, as chosen by backend_name (e.g. from
+    --clipboard) or automatically. Closed on exit.
+    '''
+    name = backend_name or default_backend_name(persistent)
+    backend = _backends.get(name)
+    if backend is None:
+        backend = _backends[name] = open_backend(name)
+        atexit.register(backend.close)
+    return backend
+
+def copy_text(text):
+    get_backend().copy(text)
+
+class AsyncClipboard(object):
+    '''
+    Hands copies off to a background thread so submit() never blocks the
+    caller. Only the most recently submitted string matters on a clipboard,
+    so anything still waiting when a new one is submitted is skipped.
+    '''
+    def __init__(self, backend=None):
+        self.backend = backend or get_backend(persistent=True)
+        self.latency = Latency()
+        self.skipped = 0
+        self.errors = []
+        self.pending = None
+        self.busy = False
+        self.closed = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, text):
+        with self.condition:
+            if self.pending is not None:
+                self.skipped += 1
+            self.pending = (text, time.perf_counter())
+            self.condition.notify_all()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.pending is None and not self.closed:
+                    self.condition.wait()
+                if self.pending is None:
+                    return
+                (text, submitted), self.pending = self.pending, None
+                self.busy = True
+            try:
+                self.backend.copy(text)
+            except Exception as e:
+                self.errors.append(e)
+                print('Clipboard copy failed: %s' % e, file=sys.stderr)
+            with self.condition:
+                self.busy = False
+                # Submission to completion, including any time spent queued
+                self.latency.add(time.perf_counter() - submitted)
+                self.condition.notify_all()
+
+    def flush(self):
+        with self.condition:
+            while self.pending is not None or self.busy:
+                self.condition.wait()
+
+    def close(self):
+        self.flush()
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def serve_helper(backend, input_file=None, output_file=None):
+    '''
+    The helper protocol: copy each line read from input_file and answer it
+    with "ok" (or "error: ..."), one line each.
+    '''
+    input_file = input_file or sys.stdin.buffer
+    output_file = output_file or sys.stdout.buffer
+    for line in input_file:
+        try:
+            backend.copy(line.rstrip(b'\r\n'))
+            output_file.write(b'ok\n')
+        except Exception as e:
+            output_file.write(('error: %s\n' % e).encode('utf-8', 'replace'))
+        output_file.flush()
+
+def main():
+    parser = argparse.ArgumentParser(description='Clipboard helper process for edgalmap')
+    parser.add_argument('backend', nargs='?', default=None, help='Backend to copy with: %s (default automatic)' % ', '.join(sorted(backends)))
+    args = parser.parse_args()
+    name = args.backend or default_backend_name()
+    if name == 'helper':
+        parser.error('the helper cannot copy via another helper')
+    backend = open_backend(name)
+    try:
+        serve_helper(backend)
+    finally:
+        backend.close()
+
+if __name__ == '__main__':
+    sys.exit(main())
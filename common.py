@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+# Helpers shared by the journal index (journal.py), the crash log index
+# (crash_monitor.py) and the scripts that scan the Spansh dump with a pool of
+# worker processes.
+
+import gzip
+import json
+import os
+import shutil
+import signal
+import subprocess
+import sys
+
+import profiling
+
+def init_worker():
+    # Leave Ctrl+C to the main process so it can offer to save partial results
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    profiling.disable_in_worker()
+
+def windows_path(path):
+    '''
+    Convert a native Windows path (built from e.g. %USERPROFILE%) to one we
+    can open, which under Cygwin or WSL means asking cygpath or wslpath.
+    Returns None if there is no way to convert it.
+    '''
+    if sys.platform == 'win32':
+        return path
+    for convert in ('cygpath', 'wslpath'):
+        if shutil.which(convert):
+            return subprocess.run([convert, '-u', path], capture_output=True, text=True).stdout.strip() or None
+    return None
+
+def read_appended(filename, offset=0):
+    '''
+    Read the whole lines appended to filename since offset, leaving any
+    partial last line for next time as its writer may be half way through it.
+    Returns the lines and the offset to carry on from.
+    '''
+    with open(filename, 'rb') as f:
+        f.seek(offset)
+        data = f.read()
+    end = data.rfind(b'\n') + 1
+    return data[:end].splitlines(), offset + end
+
+class OffsetIndex(object):
+    '''
+    Base for the indexes summarising files that are only ever appended to,
+    which remember how far they have read so each update only reads what is
+    new. Saved as gzipped JSON, and thrown away on loading if version has
+    changed since. Subclasses implement to_json, from_json and update.
+    '''
+    version = None
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    @classmethod
+    def load(cls, filename):
+        index = cls(filename)
+        try:
+            with gzip.open(filename, 'rt') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return index
+        if data.get('version') != cls.version:
+            # Start over rather than trust an index we don't understand
+            return index
+        index.from_json(data)
+        return index
+
+    def save(self):
+        data = self.to_json()
+        data['version'] = self.version
+        tmp_filename = '%s.%i.tmp' % (self.filename, os.getpid())
+        with gzip.open(tmp_filename, 'wt', compresslevel=1) as f:
+            json.dump(data, f)
+        os.replace(tmp_filename, self.filename)
+
+    def update_and_save(self, *args):
+        # Saving is only to spare the next update the work, so don't fail if
+        # we can't (e.g. a read only install)
+        if self.update(*args):
+            try:
+                self.save()
+            except OSError:
+                pass
@@ -0,0 +1,404 @@
+#!/usr/bin/env python3
+
+# Watches for the game exiting and keeps a history of which galaxy map search
+# strings crash it, to replace monitor_crashes.sh.
+#
+# Every string edgalmap copies to the clipboard is appended to CrashLog.jsonl
+# (see record_copy, set $EDGALMAP_CRASH_LOG to another file, or to nothing
+# to turn this off), and the watcher appends an event each time the game
+# starts or exits, noting whether the crash reporter showed up afterwards. A
+# crash is blamed on the last string copied before it, if that was no more
+# than crash_window seconds earlier. The log is only ever appended to, by any
+# number of processes at once, and is summarised into CrashIndex.json.gz,
+# which like the journal index only reads what has been appended since it was
+# last updated:
+#
+#   ./crash_monitor.py watch            # leave running while playing
+#   ./crash_monitor.py crashes          # every crash and what was copied
+#   ./crash_monitor.py history          # every string copied and how often it crashed
+#   ./crash_monitor.py history --crashed Col 69
+#
+# How the game is found is up to a liveness backend:
+#
+#   proc     - Linux /proc, waiting on a pidfd for the process to exit so
+#              that nothing runs at all while the game is up (also useful to
+#              try the watcher out on any process, e.g. --process sleep)
+#   win32    - Native Windows / Cygwin Python, waiting on the process handle
+#   tasklist - Polls tasklist.exe, like monitor_crashes.sh (WSL)
+
+import argparse
+import glob
+import json
+import os
+import select
+import shutil
+import signal
+import subprocess
+import sys
+import time
+
+from common import windows_path, read_appended, OffsetIndex
+
+data_dir = os.path.dirname(os.path.abspath(__file__))
+crash_log_file = os.environ.get('EDGALMAP_CRASH_LOG', os.path.join(data_dir, 'CrashLog.jsonl'))
+# Kept next to the log, so a log given in $EDGALMAP_CRASH_LOG gets its own
+crash_index_file = os.path.join(os.path.dirname(crash_log_file) or data_dir, 'CrashIndex.json.gz')
+crash_index_version = 1
+
+game_process = 'EliteDangerous64.exe'
+crash_reporter_process = 'CrashReporter.exe'
+
+# A crash more than this many seconds after the last copy isn't blamed on it
+crash_window = 120.0
+
+# How long after the game exits to wait for the crash reporter to show up
+crash_reporter_wait = 5.0
+
+# How often to look for the game while it isn't running, and for backends
+# that can't wait on a process, how often to check it is still running
+poll_interval = 2.0
+
+def append_event(event, filename=None):
+    # One line per event written with a single append, so that several
+    # processes can share the log without tearing each other's lines
+    line = (json.dumps(event, separators=(',', ':')) + '\n').encode('utf-8')
+    fd = os.open(filename or crash_log_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+
+def record_copy(text):
+    '''
+    clipboard copy hook (see clipboard.copy_hooks) logging each string copied
+    '''
+    try:
+        append_event({'time': time.time(), 'event': 'copy', 'text': text.decode('ascii', 'replace')})
+    except OSError as e:
+        # Never let the log get in the way of the clipboard
+        print('Unable to write crash log: %s' % e, file=sys.stderr)
+
+def enable_copy_log():
+    if not crash_log_file:
+        return
+    import clipboard
+    if record_copy not in clipboard.copy_hooks:
+        clipboard.copy_hooks.append(record_copy)
+
+class ProcLiveness(object):
+    name = 'proc'
+
+    def find(self, process):
+        # Linux process names are truncated to 15 characters in comm, so
+        # compare against the start of the command line as well
+        for pid in os.listdir('/proc'):
+            if not pid.isnumeric():
+                continue
+            try:
+                with open('/proc/%s/comm' % pid, 'rb') as f:
+                    comm = f.read().rstrip(b'\n').decode('utf-8', 'replace')
+                if comm != process[:15]:
+                    continue
+                if len(process) > 15:
+                    with open('/proc/%s/cmdline' % pid, 'rb') as f:
+                        argv0 = f.read().split(b'\0')[0].decode('utf-8', 'replace')
+                    if os.path.basename(argv0) != process:
+                        continue
+            except OSError:
+                continue
+            return int(pid)
+        return None
+
+    def wait(self, pid, timeout=None):
+        # True once the process has exited, False on timeout
+        if hasattr(os, 'pidfd_open'):
+            try:
+                fd = os.pidfd_open(pid)
+            except ProcessLookupError:
+                return True
+            try:
+                return bool(select.select([fd], [], [], timeout)[0])
+            finally:
+                os.close(fd)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while os.path.exists('/proc/%i' % pid):
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(poll_interval)
+        return True
+
+    def kill(self, process):
+        pid = self.find(process)
+        if pid is not None:
+            os.kill(pid, signal.SIGKILL)
+
+class TasklistLiveness(object):
+    name = 'tasklist'
+
+    def find(self, process):
+        output = subprocess.run(['tasklist.exe', '/FI', 'IMAGENAME eq %s' % process, '/FO', 'CSV', '/NH'],
+                capture_output=True, text=True).stdout
+        for line in output.splitlines():
+            fields = [x.strip('"') for x in line.split('","')]
+            if len(fields) > 1 and fields[0].lower() == process.lower() and fields[1].isnumeric():
+                return int(fields[1])
+        return None
+
+    def running(self, pid):
+        output = subprocess.run(['tasklist.exe', '/FI', 'PID eq %i' % pid, '/FO', 'CSV', '/NH'],
+                capture_output=True, text=True).stdout
+        return '"%i"' % pid in output
+
+    def wait(self, pid, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.running(pid):
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(poll_interval)
+        return True
+
+    def kill(self, process):
+        subprocess.run(['taskkill.exe', '/F', '/IM', process], capture_output=True)
+
+class Win32Liveness(TasklistLiveness):
+    '''
+    Only needs tasklist.exe to find the game, then waits on its process handle
+    '''
+    name = 'win32'
+    SYNCHRONIZE = 0x00100000
+    WAIT_OBJECT_0 = 0
+    INFINITE = 0xffffffff
+
+    def __init__(self):
+        import ctypes
+        self.kernel32 = ctypes.WinDLL('kernel32', use_last_error=True)
+
+    def wait(self, pid, timeout=None):
+        handle = self.kernel32.OpenProcess(self.SYNCHRONIZE, False, pid)
+        if not handle:
+            return True
+        try:
+            ms = self.INFINITE if timeout is None else int(timeout * 1000)
+            return self.kernel32.WaitForSingleObject(handle, ms) == self.WAIT_OBJECT_0
+        finally:
+            self.kernel32.CloseHandle(handle)
+
+liveness_backends = {
+    'proc': ProcLiveness,
+    'win32': Win32Liveness,
+    'tasklist': TasklistLiveness,
+}
+
+def default_liveness():
+    if sys.platform in ('win32', 'cygwin'):
+        try:
+            return Win32Liveness()
+        except (ImportError, OSError, AttributeError):
+            pass
+    if shutil.which('tasklist.exe'):
+        return TasklistLiveness()
+    return ProcLiveness()
+
+def crash_dump_dir():
+    local_app_data = os.environ.get('LOCALAPPDATA')
+    if not local_app_data:
+        return None
+    return windows_path(local_app_data + r'\Temp\Frontier Developments\EliteDangerous\CrashDumps')
+
+def clean_up_crash(liveness):
+    # What monitor_crashes.sh did after each crash: close the crash reporter
+    # and throw away the crash dumps, which would otherwise pile up
+    liveness.kill(crash_reporter_process)
+    dump_dir = crash_dump_dir()
+    if dump_dir:
+        for dump in glob.glob(os.path.join(glob.escape(dump_dir), '*', '*.dmp')):
+            try:
+                os.unlink(dump)
+                os.rmdir(os.path.dirname(dump))
+            except OSError:
+                pass
+
+def watch(liveness, process=game_process, crash_reporter=crash_reporter_process, clean_up=False, log=print):
+    while True:
+        pid = liveness.find(process)
+        if pid is None:
+            time.sleep(poll_interval)
+            continue
+        append_event({'time': time.time(), 'event': 'start', 'pid': pid})
+        log('%s running (pid %i)' % (process, pid))
+        liveness.wait(pid)
+        exited = time.time()
+        crashed = False
+        if crash_reporter:
+            deadline = time.monotonic() + crash_reporter_wait
+            while True:
+                if liveness.find(crash_reporter) is not None:
+                    crashed = True
+                    break
+                if time.monotonic() >= deadline:
+                    break
+                time.sleep(0.5)
+        else:
+            # Without a crash reporter to go by, count every exit
+            crashed = True
+        append_event({'time': exited, 'event': 'exit', 'pid': pid, 'crashed': crashed})
+        index = load_index()
+        crash = index.crashes[-1] if crashed and index.crashes else None
+        if crashed:
+            log('CRASH at %s, last copied: %s' % (format_time(exited), crash and crash['text']))
+        else:
+            log('%s exited' % process)
+        if crashed and clean_up:
+            clean_up_crash(liveness)
+
+class CrashIndex(OffsetIndex):
+    '''
+    Summary of the crash log: every string copied with how many times it
+    was copied and how many crashes followed it, and every crash with the
+    string blamed for it. Remembers how far into the log it has read, along
+    with the last copy and game start seen, so updates carry on from there.
+    '''
+    version = crash_index_version
+
+    def __init__(self, filename=crash_index_file):
+        OffsetIndex.__init__(self, filename)
+        self.offset = 0
+        # Text -> {'copies', 'crashes', 'first', 'last', 'last_crash'}
+        self.copies = {}
+        # [{'time', 'text' (or None), 'copied' (time, or None)}] in order
+        self.crashes = []
+        self.last_copy = None
+        self.last_start = None
+
+    @classmethod
+    def load(cls, filename=crash_index_file):
+        return super().load(filename)
+
+    def from_json(self, data):
+        self.offset = data['offset']
+        self.copies = data['copies']
+        self.crashes = data['crashes']
+        self.last_copy = data['last_copy']
+        self.last_start = data['last_start']
+
+    def to_json(self):
+        return {
+            'offset': self.offset,
+            'copies': self.copies,
+            'crashes': self.crashes,
+            'last_copy': self.last_copy,
+            'last_start': self.last_start,
+        }
+
+    def add_event(self, event):
+        t = event.get('time')
+        kind = event.get('event')
+        if kind == 'copy':
+            text = event.get('text')
+            stats = self.copies.get(text)
+            if stats is None:
+                stats = self.copies[text] = {'copies': 0, 'crashes': 0, 'first': t, 'last_crash': None}
+            stats['copies'] += 1
+            stats['last'] = t
+            self.last_copy = [t, text]
+        elif kind == 'start':
+            self.last_start = t
+        elif kind == 'exit' and event.get('crashed'):
+            crash = {'time': t, 'text': None, 'copied': None}
+            if self.last_copy is not None:
+                copied, text = self.last_copy
+                # Strings copied before the game was last started can still
+                # be pasted after, so only the time since the copy counts
+                if 0 <= t - copied <= crash_window:
+                    crash['text'] = text
+                    crash['copied'] = copied
+                    self.copies[text]['crashes'] += 1
+                    self.copies[text]['last_crash'] = t
+                    # Don't blame it again unless it is copied again
+                    self.last_copy = None
+            self.crashes.append(crash)
+
+    def update(self, log_file=None):
+        '''
+        Read anything appended to the log since the last update. Returns the
+        number of events read.
+        '''
+        log_file = log_file or crash_log_file
+        try:
+            if os.path.getsize(log_file) < self.offset:
+                # Only ever appended to, so this is a new log - start over
+                self.__init__(self.filename)
+            lines, self.offset = read_appended(log_file, self.offset)
+        except FileNotFoundError:
+            return 0
+        events = 0
+        for line in lines:
+            try:
+                event = json.loads(line)
+            except ValueError:
+                continue
+            if isinstance(event, dict):
+                self.add_event(event)
+                events += 1
+        return events
+
+def load_index(filename=crash_index_file, log_file=None):
+    # Load the index and bring it up to date with the log
+    index = CrashIndex.load(filename)
+    index.update_and_save(log_file)
+    return index
+
+def format_time(t):
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(t))
+
+def print_crashes(index, match=None):
+    for crash in index.crashes:
+        if match and (crash['text'] is None or match not in crash['text'].casefold()):
+            continue
+        if crash['text'] is None:
+            print('%s: nothing newly copied within %is' % (format_time(crash['time']), crash_window))
+        else:
+            print('%s: "%s" (copied %is before)' % (format_time(crash['time']), crash['text'],
+                crash['time'] - crash['copied']))
+
+def print_history(index, match=None, crashed=False):
+    for text, stats in sorted(index.copies.items(), key=lambda x: x[1]['last']):
+        if match and match not in text.casefold():
+            continue
+        if crashed and not stats['crashes']:
+            continue
+        print('"%s": copied %i times, last %s, %i crashes%s' % (text, stats['copies'], format_time(stats['last']),
+            stats['crashes'], ', last %s' % format_time(stats['last_crash']) if stats['last_crash'] else ''))
+
+def main():
+    parser = argparse.ArgumentParser(description='Log which galaxy map search strings crash the game')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    watch_parser = subparsers.add_parser('watch', help='Watch for the game exiting and log crashes')
+    watch_parser.add_argument('--liveness', choices=sorted(liveness_backends), help='How to find the game (default automatic)')
+    watch_parser.add_argument('--process', default=game_process, help='Process to watch (default %(default)s)')
+    watch_parser.add_argument('--crash-reporter', default=crash_reporter_process, help='Process that shows up after a crash (default %(default)s, empty to count every exit as a crash)')
+    watch_parser.add_argument('--clean-up', action='store_true', help='Close the crash reporter and delete crash dumps after each crash')
+    crashes_parser = subparsers.add_parser('crashes', help='List every crash and what was copied before it')
+    crashes_parser.add_argument('match', nargs='*', help='Only crashes blamed on strings containing this')
+    history_parser = subparsers.add_parser('history', help='List every string copied and how often it crashed the game')
+    history_parser.add_argument('--crashed', action='store_true', help='Only strings that crashed the game')
+    history_parser.add_argument('match', nargs='*', help='Only strings containing this')
+    args = parser.parse_args()
+
+    if args.command == 'watch':
+        liveness = liveness_backends[args.liveness]() if args.liveness else default_liveness()
+        print('Watching for %s with the %s backend, logging to %s' % (args.process, liveness.name, crash_log_file))
+        try:
+            watch(liveness, args.process, args.crash_reporter, args.clean_up)
+        except KeyboardInterrupt:
+            pass
+        return 0
+    index = load_index()
+    match = ' '.join(args.match).casefold() or None
+    if args.command == 'crashes':
+        print_crashes(index, match)
+    else:
+        print_history(index, match, args.crashed)
+
+if __name__ == '__main__':
+    sys.exit(main())
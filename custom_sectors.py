@@ -0,0 +1,454 @@
+#!/usr/bin/env python3
+
+# Hand authored sectors, such as "Col 69 Sector", are spheres (a centre and a
+# radius) laid over the procedural sectors rather than 1280ly cubes of their
+# own. Systems in them are named just like procedural systems, except that
+# the boxel letters count boxels from the sector's corner (its centre minus
+# its radius on each axis) snapped down to the cube layer's boxel grid. So to
+# turn a name like "Col 69 Sector WL-Q b20-0" into a SystemAddress we need to
+# know where that corner is, to the nearest boxel.
+#
+# CustomSectors.json lists the custom sectors we know about, in priority
+# order for where they overlap. Each has a centre and radius, which places
+# the corner exactly, and/or some of its systems with their SystemAddresses,
+# each of which places the corner to within one boxel of its cube layer (so a
+# layer a system is enough for every layer, while a layer b system is enough
+# for every layer but a). Systems can be learned from the journals of systems
+# visited, or from the Spansh systems dump, which also has the coordinates to
+# fit each sector's centre and radius, or added by hand:
+#
+#   ./custom_sectors.py learn --dump systems.json.gz
+#   ./custom_sectors.py learn --journals
+#   ./custom_sectors.py learn "Col 69 Sector WL-Q b20-0" 677127660481
+#   ./custom_sectors.py add "Col 69 Sector" X Y Z RADIUS
+#   ./custom_sectors.py list
+
+import argparse
+import collections
+import gzip
+import json
+import math
+import multiprocessing
+import os
+import sys
+
+import edgalmap
+from common import init_worker
+
+custom_sectors_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'CustomSectors.json')
+
+class CustomSector(object):
+    def __init__(self, name, centre=None, radius=None, systems=None):
+        self.name = name
+        self.centre = centre
+        self.radius = radius
+        # System name -> SystemAddress, for the systems that place the corner
+        self.systems = {}
+        # The corner lies within [lo, hi) on each axis, or exactly at lo if
+        # lo == hi
+        self.lo = [-math.inf] * 3
+        self.hi = [math.inf] * 3
+        if centre is not None:
+            self.lo = [x - radius for x in centre]
+            self.hi = list(self.lo)
+        # Boxel of the corner in each cube layer, counted from the corner of
+        # the galaxy
+        self.origins = [None] * 8
+        for system_name, system_address in (systems or {}).items():
+            self.learn(system_name, system_address)
+
+    def learn(self, system_name, system_address):
+        '''
+        Narrow down where the corner is from a system in this sector. Raises
+        ValueError if the system doesn't agree with what is already known.
+        '''
+        prefix, cube_layer, boxel_remainder, system_id = edgalmap.parse_system_name(system_name)
+        sector_name, _, boxel_string = prefix.rpartition(' ')
+        if sector_name.casefold() != self.name.casefold():
+            raise ValueError('%s is not in %s' % (system_name, self.name))
+        fields = edgalmap.split_system_address(system_address)
+        if fields.cube_layer != cube_layer:
+            raise ValueError('%s is not in cube layer %s' % (system_address, chr(ord('a') + cube_layer)))
+        size = edgalmap.boxel_size(cube_layer)
+        boxels = 1 << (7 - cube_layer)
+        lo, hi = list(self.lo), list(self.hi)
+        for axis, boxel in enumerate(edgalmap.boxel_position(boxel_string, boxel_remainder)):
+            origin = fields[1 + axis] * boxels + fields[4 + axis] - boxel
+            corner = edgalmap.galaxy_origin[axis] + origin * size
+            if lo[axis] == hi[axis]:
+                if not corner <= lo[axis] < corner + size:
+                    raise ValueError('%s does not agree with the centre and radius of %s' % (system_name, self.name))
+                continue
+            lo[axis] = max(lo[axis], corner)
+            hi[axis] = min(hi[axis], corner + size)
+            if lo[axis] >= hi[axis]:
+                raise ValueError('%s does not agree with the systems already known in %s' % (system_name, self.name))
+        self.lo, self.hi = lo, hi
+        self.origins = [None] * 8
+        self.systems[system_name] = system_address
+
+    def origin(self, cube_layer):
+        '''
+        Boxel (x, y, z) of the corner in the given cube layer, counted from the
+        corner of the galaxy. Raises KeyError if it isn't known well enough.
+        '''
+        origin = self.origins[cube_layer]
+        if origin is None:
+            size = edgalmap.boxel_size(cube_layer)
+            origin = []
+            for axis in range(3):
+                first = math.floor((self.lo[axis] - edgalmap.galaxy_origin[axis]) / size) \
+                        if self.lo[axis] > -math.inf else None
+                last = math.ceil((self.hi[axis] - edgalmap.galaxy_origin[axis]) / size) - 1 \
+                        if self.hi[axis] > self.lo[axis] else first
+                if first is None or first != last:
+                    raise KeyError('Not enough known about %s to place cube layer %s boxels, see custom_sectors.py' % (
+                        self.name, chr(ord('a') + cube_layer)))
+                origin.append(first)
+            origin = self.origins[cube_layer] = tuple(origin)
+        return origin
+
+    def known_layers(self):
+        layers = []
+        for cube_layer in range(8):
+            try:
+                self.origin(cube_layer)
+                layers.append(cube_layer)
+            except KeyError:
+                pass
+        return layers
+
+    def contains(self, position):
+        return self.centre is not None and math.dist(self.centre, position) <= self.radius
+
+    def to_json(self):
+        j = {'name': self.name}
+        if self.centre is not None:
+            j['centre'] = self.centre
+            j['radius'] = self.radius
+        if self.systems:
+            j['systems'] = self.systems
+        return j
+
+class CustomSectors(object):
+    '''
+    The custom sectors from CustomSectors.json, by name and by position
+    '''
+    def __init__(self, sectors=(), filename=custom_sectors_file):
+        self.filename = filename
+        self.sectors = []
+        self.by_name = {}
+        # Sector (as in SectorX/Y/Z) -> custom sectors whose bounding box
+        # overlaps it, for finding which contain a position
+        self.grid = collections.defaultdict(list)
+        for sector in sectors:
+            self.add(sector)
+
+    @classmethod
+    def load(cls, filename=custom_sectors_file):
+        try:
+            with open(filename, 'r') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return cls(filename=filename)
+        return cls([CustomSector(s['name'], s.get('centre'), s.get('radius'), s.get('systems'))
+                for s in data['sectors']], filename)
+
+    def save(self):
+        tmp_filename = '%s.%i.tmp' % (self.filename, os.getpid())
+        with open(tmp_filename, 'w') as f:
+            json.dump({'sectors': [s.to_json() for s in self.sectors]}, f, indent=1)
+            f.write('\n')
+        os.replace(tmp_filename, self.filename)
+
+    def __len__(self):
+        return len(self.sectors)
+
+    def __iter__(self):
+        return iter(self.sectors)
+
+    def _grid_cells(self, sector):
+        ranges = [range(math.floor((c - sector.radius - o) / edgalmap.sector_size),
+                        math.floor((c + sector.radius - o) / edgalmap.sector_size) + 1)
+                for c, o in zip(sector.centre, edgalmap.galaxy_origin)]
+        return [(x, y, z) for x in ranges[0] for y in ranges[1] for z in ranges[2]]
+
+    def add(self, sector):
+        old = self.by_name.get(sector.name.casefold())
+        if old is not None:
+            # Keep its place in the priority order
+            self.sectors[self.sectors.index(old)] = sector
+            if old.centre is not None:
+                for cell in self._grid_cells(old):
+                    self.grid[cell].remove(old)
+        else:
+            self.sectors.append(sector)
+        self.by_name[sector.name.casefold()] = sector
+        if sector.centre is not None:
+            for cell in self._grid_cells(sector):
+                self.grid[cell].append(sector)
+                self.grid[cell].sort(key=self.sectors.index)
+
+    def get(self, sector_name):
+        sector = self.by_name.get(' '.join(sector_name.split()).casefold())
+        if sector is None:
+            raise KeyError('Unknown sector: %s, see custom_sectors.py' % sector_name)
+        return sector
+
+    def containing(self, position):
+        '''
+        Custom sectors with a known centre and radius containing a galactic
+        position, highest priority first
+        '''
+        cell = tuple(math.floor((x - o) / edgalmap.sector_size) for x, o in zip(position, edgalmap.galaxy_origin))
+        return [sector for sector in self.grid.get(cell, ()) if sector.contains(position)]
+
+    def locate(self, sector_name, cube_layer, boxel_x, boxel_y, boxel_z):
+        '''
+        (sector_x, sector_y, sector_z, boxel_x, boxel_y, boxel_z) for the
+        SystemAddress of a boxel given relative to a custom sector's corner,
+        as in its system names
+        '''
+        origin = self.get(sector_name).origin(cube_layer)
+        boxel_bits = 7 - cube_layer
+        mask = (1 << boxel_bits) - 1
+        x, y, z = (o + b for o, b in zip(origin, (boxel_x, boxel_y, boxel_z)))
+        return (x >> boxel_bits, y >> boxel_bits, z >> boxel_bits, x & mask, y & mask, z & mask)
+
+    def system_names(self, system_address):
+        '''
+        Names a system may go by in the custom sectors containing (the centre
+        of the boxel of) its SystemAddress, highest priority first
+        '''
+        fields = edgalmap.split_system_address(system_address)
+        boxels = 1 << (7 - fields.cube_layer)
+        names = []
+        for sector in self.containing(edgalmap.system_position(system_address)):
+            origin = sector.origin(fields.cube_layer)
+            boxel = [fields[1 + axis] * boxels + fields[4 + axis] - origin[axis] for axis in range(3)]
+            if min(boxel) < 0 or max(boxel) > 0x7f:
+                continue
+            boxel_key = boxel[0] | boxel[1] << 7 | boxel[2] << 14
+            names.append('%s %s-%s %s%s%i' % (sector.name, edgalmap.boxel_letter_pairs[boxel_key % 676],
+                chr(ord('A') + boxel_key // 676 % 26), chr(ord('a') + fields.cube_layer),
+                '%i-' % (boxel_key // 26**3) if boxel_key // 26**3 else '', fields.system_id))
+        return names
+
+    def learn(self, system_name, system_address):
+        '''
+        Add a system to its sector, adding the sector if it is new. Returns
+        the sector, or None if system_name isn't in a custom sector.
+        '''
+        system_name = ' '.join(system_name.split())
+        try:
+            prefix = edgalmap.parse_system_name(system_name)[0]
+        except ValueError:
+            return None
+        sector_name = prefix.rpartition(' ')[0]
+        if not sector_name or sector_names_procedural(sector_name):
+            return None
+        try:
+            sector = self.get(sector_name)
+        except KeyError:
+            sector = CustomSector(sector_name)
+            self.add(sector)
+        sector.learn(system_name, system_address)
+        return sector
+
+def sector_names_procedural(sector_name):
+    try:
+        edgalmap.galaxy.sectors.key(sector_name)
+        return True
+    except KeyError:
+        return False
+
+def learn_journals(sectors, journal_dir=None):
+    import journal
+    index = journal.load_index(journal_dir=journal_dir)
+    learned = 0
+    for system_address, (name, body_ids) in index.systems.items():
+        if not name:
+            continue
+        try:
+            if sectors.learn(name, system_address) is not None:
+                learned += 1
+        except (ValueError, AssertionError) as e:
+            print('Skipping %s: %s' % (name, e))
+    return learned
+
+def custom_systems_chunk(chunk):
+    # Runs in the worker processes: (name, SystemAddress, coordinates) of
+    # every system in a block of lines from the Spansh dump that is named
+    # like a procedural system, but in a sector that isn't procedural
+    import update_named_systems
+    systems = []
+    for line in chunk.split(b'\n'):
+        line = line.rstrip(b',\r')
+        if not line or line in (b'[', b']'):
+            continue
+        j = json.loads(line)
+        name = ' '.join(j['name'].split())
+        if not update_named_systems.is_procedural_name(name):
+            continue
+        if sector_names_procedural(name.rpartition(' ')[0].rpartition(' ')[0]):
+            continue
+        coords = j.get('coords')
+        systems.append((name, j['id64'], coords and [coords['x'], coords['y'], coords['z']]))
+    return systems
+
+def scan_dump(dump_file, jobs=None):
+    import update_named_systems
+    with gzip.open(dump_file) as f:
+        chunks = (chunk for offset, chunk in update_named_systems.read_chunks(f))
+        if jobs == 1:
+            for chunk in chunks:
+                yield from custom_systems_chunk(chunk)
+            return
+        jobs = jobs or os.cpu_count()
+        with multiprocessing.Pool(jobs, init_worker) as pool:
+            # A bounded number of blocks in flight, as in verify_codec.py
+            pending = collections.deque()
+            for chunk in chunks:
+                pending.append(pool.apply_async(custom_systems_chunk, (chunk,)))
+                if len(pending) >= jobs * 2:
+                    yield from pending.popleft().get()
+            while pending:
+                yield from pending.popleft().get()
+
+def fit_sphere(sector, positions):
+    '''
+    Centre and radius of a sphere around positions, nudged so that its corner
+    is where sector's systems put it
+    '''
+    # A sphere filled with systems all the way out shares the middle of their
+    # bounding box. Rounded up to 1/32 ly so rounding errors don't leave the
+    # furthest system out.
+    centre = [(min(p[axis] for p in positions) + max(p[axis] for p in positions)) / 2 for axis in range(3)]
+    radius = math.ceil(max(math.dist(p, centre) for p in positions) * 32) / 32
+    corner = [min(max(c - radius, lo), math.nextafter(hi, lo)) for c, lo, hi in zip(centre, sector.lo, sector.hi)]
+    return [c + radius for c in corner], radius
+
+def learn_dump(sectors, dump_file, jobs=None):
+    '''
+    Place every custom sector with systems in a Spansh systems dump, by its
+    centre and radius where its systems place its corner in every cube layer
+    and are enough to fit them, or otherwise by its lowest cube layer
+    system. Returns the number of custom sectors placed.
+    '''
+    found = {}
+    positions = collections.defaultdict(list)
+    skipped = 0
+    for name, system_address, position in scan_dump(dump_file, jobs):
+        sector_name = name.rpartition(' ')[0].rpartition(' ')[0]
+        sector = found.get(sector_name.casefold())
+        if sector is None:
+            sector = found[sector_name.casefold()] = CustomSector(sector_name)
+        try:
+            sector.learn(name, system_address)
+        except (ValueError, AssertionError):
+            skipped += 1
+            continue
+        if position is not None:
+            positions[sector.name].append(position)
+    if skipped:
+        print('Skipped %i systems that disagree with the others in their sector' % skipped)
+    for sector in found.values():
+        if not sector.systems:
+            continue
+        try:
+            old = sectors.get(sector.name)
+        except KeyError:
+            old = None
+        # Only once the corner is known to the nearest layer a boxel can the
+        # centre and radius be trusted to place every cube layer
+        if 0 in sector.known_layers() and positions[sector.name]:
+            centre, radius = fit_sphere(sector, positions[sector.name])
+            try:
+                # Keep any systems added by hand, which have to agree
+                placed = CustomSector(sector.name, centre, radius, old.systems if old else None)
+            except ValueError as e:
+                print(e)
+            else:
+                outside = sum(not placed.contains(p) for p in positions[sector.name])
+                if outside:
+                    print('%s: %i of %i systems are outside the fitted centre and radius' % (
+                        sector.name, outside, len(positions[sector.name])))
+                sectors.add(placed)
+                continue
+        print('Unable to fit a centre and radius to %s' % sector.name)
+        # Every system in a cube layer places the corner the same, and the
+        # lowest layer known places it for the layers above too
+        systems = dict(old.systems) if old else {}
+        system_name, system_address = min(sector.systems.items(), key=lambda x: x[1] & 7)
+        systems[system_name] = system_address
+        try:
+            sectors.add(CustomSector(sector.name, old and old.centre, old and old.radius, systems))
+        except ValueError as e:
+            print('Keeping what was known about %s: %s' % (sector.name, e))
+    return len(found)
+
+def describe(sector):
+    layers = sector.known_layers()
+    known = ', '.join(chr(ord('a') + cube_layer) for cube_layer in layers) or 'none'
+    where = ' centre %s radius %s,' % (tuple(sector.centre), sector.radius) if sector.centre is not None else ''
+    return '%s:%s %i known systems, cube layers %s' % (sector.name, where, len(sector.systems), known)
+
+def main():
+    parser = argparse.ArgumentParser(description='Maintain the table of custom (XYZ + radius) sectors')
+    parser.add_argument('-f', '--file', default=custom_sectors_file, help='Custom sectors table (default %(default)s)')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.add_parser('list', help='List the custom sectors and which cube layers can be encoded')
+    learn_parser = subparsers.add_parser('learn', help='Place custom sectors from systems with known SystemAddresses')
+    learn_parser.add_argument('--dump', metavar='FILE', help='Learn from every system in the Spansh systems dump FILE (e.g. systems.json.gz), fitting a centre and radius to each sector')
+    learn_parser.add_argument('-j', '--jobs', type=int, default=None, help='Number of worker processes reading the dump (default one per CPU)')
+    learn_parser.add_argument('--journals', action='store_true', help='Learn from every system seen in the journals')
+    learn_parser.add_argument('--journal-dir', help='Journal directory (default automatic, or set $EDGALMAP_JOURNAL_DIR)')
+    learn_parser.add_argument('system', nargs='*', help='System name and SystemAddress')
+    add_parser = subparsers.add_parser('add', help='Add or update the centre and radius of a custom sector')
+    add_parser.add_argument('name')
+    add_parser.add_argument('x', type=float)
+    add_parser.add_argument('y', type=float)
+    add_parser.add_argument('z', type=float)
+    add_parser.add_argument('radius', type=float)
+    name_parser = subparsers.add_parser('names', help='Names of a system in any custom sectors containing it')
+    name_parser.add_argument('system_address', type=int)
+    args = parser.parse_args()
+
+    sectors = CustomSectors.load(args.file)
+    if args.command == 'learn':
+        if args.dump:
+            print('Placed %i custom sectors from %s' % (learn_dump(sectors, args.dump, args.jobs), args.dump))
+        if args.journals:
+            print('Learned %i systems from the journals' % learn_journals(sectors, args.journal_dir))
+        if args.system:
+            if len(args.system) < 2 or not args.system[-1].isnumeric():
+                learn_parser.error('expected a system name followed by its SystemAddress')
+            system_name = ' '.join(args.system[:-1])
+            try:
+                if sectors.learn(system_name, int(args.system[-1])) is None:
+                    print('%s is not in a custom sector' % system_name)
+                    return 1
+            except (ValueError, AssertionError) as e:
+                print(e)
+                return 1
+        elif not args.journals and not args.dump:
+            learn_parser.error('nothing to learn from')
+        sectors.save()
+    elif args.command == 'add':
+        old = sectors.by_name.get(args.name.casefold())
+        try:
+            sector = CustomSector(args.name, [args.x, args.y, args.z], args.radius, old.systems if old else None)
+        except ValueError as e:
+            print(e)
+            return 1
+        sectors.add(sector)
+        sectors.save()
+    elif args.command == 'names':
+        for name in sectors.system_names(args.system_address):
+            print(name)
+        return 0
+    for sector in sectors:
+        print(describe(sector))
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,17 +1,25 @@
 #!/usr/bin/env python3
 
 import json
+import csv
+import collections
 import gzip
+import mmap
+import struct
+import array
 import argparse
-import collections
+import heapq
+import math
+import operator
 import sys, os
-try:
-    import winclipboard
-except: # Occurs on WSL, fallback to calling clip.exe
-    class winclipboard(object):
-        def copy_text_simple(text):
-            import subprocess
-            subprocess.run("clip.exe", input=text)
+import profiling
+profiling.enable_from_env()
+import sector_names
+
+if __name__ == '__main__':
+    # Modules that import edgalmap back (custom_sectors) should get this
+    # copy rather than loading and initialising a second one
+    sys.modules.setdefault('edgalmap', sys.modules[__name__])
 
 # https://forums.frontier.co.uk/threads/warning-galaxy-map-operating-beyond-safety-limits.598751/
 layers_map = {
@@ -35,65 +43,737 @@ layers_map = {
 def b(cube_layer, body_id):
     return body_id << layers_map[cube_layer]
 def b_inv(cube_layer, system_id):
-    return system_id & 2**(cube_layer+3)-1, system_id >> layers_map[cube_layer]
+    return system_id & 2**layers_map[cube_layer]-1, system_id >> layers_map[cube_layer]
+
+data_dir = os.path.dirname(os.path.abspath(__file__))
+# Sectors people have visited, used to suggest sector names in searches (the
+# names themselves are generated by sector_names.py)
+sector_lookup_file = os.path.join(data_dir, 'PGSectorNames.json')
+named_systems_file = os.path.join(data_dir, 'NamedSystems.json.gz')
+named_index_file = os.path.join(data_dir, 'NamedSystems.idx')
+search_index_file = os.path.join(data_dir, 'SearchIndex.idx')
+spatial_index_file = os.path.join(data_dir, 'SpatialIndex.idx')
 
-sector_lookup_file = os.path.join(os.path.abspath(os.path.dirname(sys.argv[0])), 'PGSectorNames.json')
-system_lookup_json = json.load(open(sector_lookup_file, 'r'), strict=False)
-system_lookup_map = { x['Key']: x['PGN'] for x in system_lookup_json['ProceduralGeneratedSectorNames'] }
 def system_lookup_key(sector_x, sector_y, sector_z):
     # "Key" seems rather unnecessary - could just take SectorX/Y/Z as a tuple and use that as the key...
     # Or better yet, the file could have been formatted to use a json map >_<
     # But anyway...
     return sector_x | sector_y<<7 | sector_z<<14
+
+def open_index(source_file, index_file, magic, build):
+    # Memory map a compiled index, rebuilding it first if it is missing, out
+    # of date or from an older version of edgalmap. source_file may be a tuple
+    # of files for indexes compiled from several.
+    source_files = source_file if isinstance(source_file, tuple) else (source_file,)
+    try:
+        if os.stat(index_file).st_mtime >= max(os.stat(f).st_mtime for f in source_files):
+            with open(index_file, 'rb') as f:
+                index = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            if index[:len(magic)] == magic:
+                return index
+    except (OSError, ValueError):
+        pass
+    with profiling.phase('build %s' % os.path.basename(index_file)):
+        index = build(source_file)
+    try:
+        tmp_file = '%s.%i.tmp' % (index_file, os.getpid())
+        with open(tmp_file, 'wb') as f:
+            f.write(index)
+        os.replace(tmp_file, index_file)
+    except OSError:
+        # Read only install, just use the index from memory this run
+        pass
+    return index
+
+def build_named_systems_index(named_systems):
+    # Case folded name -> [(name, id64), ...], with duplicate names (whether
+    # they differ only by case in the Spansh data, or share the exact same
+    # name and were grouped in a list by update_named_systems.py) already
+    # grouped together so a lookup is a single hash probe
+    index = {}
+    for name, id64s in named_systems.items():
+        if not isinstance(id64s, list):
+            id64s = [id64s]
+        index.setdefault(name.casefold(), []).extend((name, id64) for id64 in id64s)
+    return index
+
+# Compact alternative to loading NamedSystems.json.gz into a dict, which takes
+# a lot of memory for what is a static table and needs gzip + json to load.
+# The names are sorted by their case folded form (so names differing only in
+# case are adjacent) and binary searched, each with one id64 in a parallel
+# array. The few names shared by several systems keep the rest of their
+# id64s in a side table. Every id64 is also listed in sorted order with the
+# number of its name, for the reverse id64 -> name lookup. Layout (little
+# endian, 64 bit arrays 8 byte aligned):
+#   header: magic, number of names, number of duplicated names, number of
+#           extra id64s, padding
+#   names * id64
+#   extra id64s * id64
+#   (names + extra id64s) * id64, sorted
+#   (names + 1) * offset of name in the name blob
+#   duplicated names * name number, sorted
+#   (duplicated names + 1) * offset of first extra id64
+#   (names + extra id64s) * name number, in the same order as the sorted id64s
+#   names, UTF-8, concatenated
+named_index_magic = b'EDGNAME2'
+named_index_header = struct.Struct('<8sIIII')
+
+def build_named_index(named_systems_file=named_systems_file):
+    with gzip.open(named_systems_file) as f:
+        named_systems = json.load(f)
+    names = sorted(named_systems, key=lambda name: (name.casefold(), name))
+    ids = array.array('Q')
+    extra_ids = array.array('Q')
+    name_offsets = array.array('I', [0])
+    dupe_names = array.array('I')
+    dupe_offsets = array.array('I', [0])
+    blob = bytearray()
+    by_id64 = []
+    for i, name in enumerate(names):
+        id64s = named_systems[name]
+        if not isinstance(id64s, list):
+            id64s = [id64s]
+        if len(id64s) > 1:
+            dupe_names.append(i)
+            extra_ids.extend(id64s[1:])
+            dupe_offsets.append(len(extra_ids))
+        ids.append(id64s[0])
+        by_id64.extend((id64, i) for id64 in id64s)
+        blob += name.encode('utf-8')
+        name_offsets.append(len(blob))
+    by_id64.sort()
+    sorted_ids = array.array('Q', (id64 for id64, i in by_id64))
+    id64_names = array.array('I', (i for id64, i in by_id64))
+    index = bytearray(named_index_header.pack(named_index_magic, len(names), len(dupe_names), len(extra_ids), 0))
+    for a in (ids, extra_ids, sorted_ids, name_offsets, dupe_names, dupe_offsets, id64_names):
+        if sys.byteorder != 'little':
+            a.byteswap()
+        index += a.tobytes()
+    index += blob
+    return bytes(index)
+
+def index_sections(index, offset, sections):
+    # Zero copy views of consecutive arrays in a memory mapped index, given as
+    # a list of (typecode, length)
+    views = []
+    for typecode, length in sections:
+        size = length * array.array(typecode).itemsize
+        view = memoryview(index)[offset:offset+size]
+        offset += size
+        if sys.byteorder != 'little':
+            view = array.array(typecode, view.tobytes())
+            view.byteswap()
+        else:
+            view = view.cast(typecode)
+        views.append(view)
+    return views, offset
+
+class NamedSystemIndex(object):
+    '''
+    Case insensitive name -> id64 lookups from the memory mapped
+    NamedSystems.idx, compiled from NamedSystems.json.gz on first use.
+    '''
+    def __init__(self, named_systems_file=named_systems_file, index_file=named_index_file):
+        self.index = open_index(named_systems_file, index_file, named_index_magic, build_named_index)
+        magic, self.count, dupes, extra, _ = named_index_header.unpack_from(self.index, 0)
+        assert(magic == named_index_magic)
+        (self.ids, self.extra_ids, self.sorted_ids, self.name_offsets, self.dupe_names,
+            self.dupe_offsets, self.id64_names), self.names_offset = \
+            index_sections(self.index, named_index_header.size, [
+                ('Q', self.count),
+                ('Q', extra),
+                ('Q', self.count + extra),
+                ('I', self.count + 1),
+                ('I', dupes),
+                ('I', dupes + 1),
+                ('I', self.count + extra),
+            ])
+
+    def __len__(self):
+        return self.count
+
+    def name(self, i):
+        start = self.names_offset + self.name_offsets[i]
+        end = self.names_offset + self.name_offsets[i + 1]
+        return self.index[start:end].decode('utf-8')
+
+    def id64s(self, i):
+        lo, hi = 0, len(self.dupe_names)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.dupe_names[mid] < i:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self.dupe_names) and self.dupe_names[lo] == i:
+            return [self.ids[i]] + list(self.extra_ids[self.dupe_offsets[lo]:self.dupe_offsets[lo + 1]])
+        return [self.ids[i]]
+
+    def lookup(self, system_name):
+        key = system_name.casefold()
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.name(mid).casefold() < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        matches = []
+        while lo < self.count:
+            name = self.name(lo)
+            if name.casefold() != key:
+                break
+            matches.extend((name, id64) for id64 in self.id64s(lo))
+            lo += 1
+        return matches
+
+    def name_of(self, id64):
+        # Reverse lookup, returns None for systems without a custom name
+        lo, hi = 0, len(self.sorted_ids)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.sorted_ids[mid] < id64:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self.sorted_ids) and self.sorted_ids[lo] == id64:
+            return self.name(self.id64_names[lo])
+        return None
+
+    def __iter__(self):
+        for i in range(self.count):
+            name = self.name(i)
+            for id64 in self.id64s(i):
+                yield (name, id64)
+
+# Search index over the names of named systems and sectors, for suggesting
+# what someone meant when they type a partial or misspelled name. Names are
+# sorted by their case folded form, so prefix searches are a binary search,
+# and there is an inverted index of the trigrams in each name for fuzzy
+# searches. Layout (little endian, 64 bit arrays 8 byte aligned):
+#   header: magic, number of names, number of trigrams, number of postings,
+#           padding
+#   trigrams * trigram, sorted (see name_trigrams)
+#   (trigrams + 1) * offset of first posting
+#   postings * name number, sorted within each trigram
+#   (names + 1) * offset of name in the name blob
+#   names * kind (search_system or search_sector)
+#   names, UTF-8, concatenated
+search_index_magic = b'EDGSRCH1'
+search_index_header = struct.Struct('<8sIIII')
+search_system = 0
+search_sector = 1
+
+# Maximum edit distance of fuzzy matches, and how many of the names sharing
+# the most trigrams with the query get their edit distance checked
+search_max_distance = 2
+search_candidates = 200
+
+def name_trigrams(name):
+    # Trigrams of the normalised, case folded name, padded so the start and
+    # end of the name count for more. Each trigram is packed into an int.
+    name = '  %s ' % ' '.join(name.split()).casefold()
+    return {ord(name[i]) << 42 | ord(name[i+1]) << 21 | ord(name[i+2]) for i in range(len(name) - 2)}
+
+def edit_distance(a, b, bound):
+    # Levenshtein distance counting swapped adjacent letters as one edit (the
+    # most common typo), giving up with bound + 1 once it exceeds bound
+    if abs(len(a) - len(b)) > bound:
+        return bound + 1
+    before = None
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            d = min(previous[j] + 1, current[j-1] + 1, previous[j-1] + (ca != cb))
+            if before is not None and j > 1 and ca == b[j-2] and a[i-2] == cb:
+                d = min(d, before[j-2] + 1)
+            current.append(d)
+        if min(current) > bound:
+            return bound + 1
+        before, previous = previous, current
+    return previous[-1]
+
+def build_search_index(source_files=(named_systems_file, sector_lookup_file)):
+    named_systems_file, sector_lookup_file = source_files
+    with gzip.open(named_systems_file) as f:
+        names = [(name, search_system) for name in json.load(f)]
+    sectors = json.load(open(sector_lookup_file, 'r'), strict=False)['ProceduralGeneratedSectorNames']
+    names += [(x['PGN'].strip('\t'), search_sector) for x in sectors]
+    names.sort(key=lambda x: (' '.join(x[0].split()).casefold(), x[0], x[1]))
+    postings = collections.defaultdict(list)
+    name_offsets = array.array('I', [0])
+    kinds = array.array('B')
+    blob = bytearray()
+    for i, (name, kind) in enumerate(names):
+        for trigram in name_trigrams(name):
+            postings[trigram].append(i)
+        blob += name.encode('utf-8')
+        name_offsets.append(len(blob))
+        kinds.append(kind)
+    trigrams = array.array('Q', sorted(postings))
+    posting_offsets = array.array('I', [0])
+    all_postings = array.array('I')
+    for trigram in trigrams:
+        all_postings.extend(postings[trigram])
+        posting_offsets.append(len(all_postings))
+    index = bytearray(search_index_header.pack(search_index_magic, len(names), len(trigrams), len(all_postings), 0))
+    for a in (trigrams, posting_offsets, all_postings, name_offsets):
+        if sys.byteorder != 'little':
+            a.byteswap()
+        index += a.tobytes()
+    index += kinds.tobytes()
+    index += blob
+    return bytes(index)
+
+# id64s is only filled in for systems by Galaxy.search, distance is the edit
+# distance from the query, or 0 for prefix matches
+SearchMatch = collections.namedtuple('SearchMatch', 'name kind distance id64s')
+
+class SearchIndex(object):
+    '''
+    Prefix and fuzzy (misspelled) name searches over named systems and
+    sectors, from the memory mapped SearchIndex.idx.
+    '''
+    def __init__(self, source_files=(named_systems_file, sector_lookup_file), index_file=search_index_file):
+        self.index = open_index(source_files, index_file, search_index_magic, build_search_index)
+        magic, self.count, trigrams, postings, _ = search_index_header.unpack_from(self.index, 0)
+        assert(magic == search_index_magic)
+        (self.trigrams, self.posting_offsets, self.postings, self.name_offsets, self.kinds), self.names_offset = \
+            index_sections(self.index, search_index_header.size, [
+                ('Q', trigrams),
+                ('I', trigrams + 1),
+                ('I', postings),
+                ('I', self.count + 1),
+                ('B', self.count),
+            ])
+
+    def __len__(self):
+        return self.count
+
+    def name(self, i):
+        start = self.names_offset + self.name_offsets[i]
+        end = self.names_offset + self.name_offsets[i + 1]
+        return self.index[start:end].decode('utf-8')
+
+    def key(self, i):
+        return ' '.join(self.name(i).split()).casefold()
+
+    def match(self, i, distance=0):
+        return SearchMatch(self.name(i), 'sector' if self.kinds[i] == search_sector else 'system', distance, None)
+
+    def prefix(self, prefix, limit=10):
+        prefix = ' '.join(prefix.split()).casefold()
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.key(mid) < prefix:
+                lo = mid + 1
+            else:
+                hi = mid
+        matches = []
+        while lo < self.count and len(matches) < limit and self.key(lo).startswith(prefix):
+            matches.append(self.match(lo))
+            lo += 1
+        return matches
+
+    def _postings(self, trigram):
+        lo, hi = 0, len(self.trigrams)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.trigrams[mid] < trigram:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self.trigrams) and self.trigrams[lo] == trigram:
+            return self.postings[self.posting_offsets[lo]:self.posting_offsets[lo + 1]]
+        return ()
+
+    def fuzzy(self, query, limit=10, max_distance=search_max_distance):
+        query = ' '.join(query.split()).casefold()
+        postings = sorted((self._postings(trigram) for trigram in name_trigrams(query)), key=len)
+        # Each edit can only destroy up to four trigrams (three, or four for a
+        # swap), so anything within max_distance shares at least this many
+        # with the query, and so must turn up in at least one of the rarest
+        # len - needed + 1 trigrams
+        needed = len(postings) - 4 * max_distance
+        if needed > 0:
+            candidates = set()
+            for p in postings[:len(postings) - needed + 1]:
+                candidates.update(p)
+            counts = collections.Counter()
+            for p in postings:
+                counts.update(i for i in p if i in candidates)
+        else:
+            counts = collections.Counter()
+            for p in postings:
+                counts.update(p)
+        matches = []
+        for i, shared in counts.most_common(search_candidates):
+            if needed > 0 and shared < needed:
+                break
+            distance = edit_distance(query, self.key(i), max_distance)
+            if distance <= max_distance:
+                matches.append((distance, i))
+        matches.sort()
+        return [self.match(i, distance) for distance, i in matches[:limit]]
+
+    def search(self, query, limit=10, max_distance=search_max_distance):
+        '''
+        Names starting with query, followed by names within max_distance edits
+        of it, best first
+        '''
+        matches = self.prefix(query, limit)
+        if len(matches) < limit:
+            seen = {(m.name, m.kind) for m in matches}
+            matches += [m for m in self.fuzzy(query, limit, max_distance) if (m.name, m.kind) not in seen][:limit - len(matches)]
+        return matches
+
+# Spatial index over the approximate positions (see system_position) of named
+# systems, for finding the named systems nearest a point. Positions are boxel
+# centres, which always fall on whole light years, and many named systems
+# share a boxel, so each distinct position is stored once with the range of
+# id64s there. The positions are laid out as an implicit k-d tree: the root is
+# the middle position, with those in the first half at or below it on the x
+# axis and those in the second half at or above it, and so on down each half
+# splitting on y, then z, then x again until there are no more than
+# spatial_leaf_size left, which are scanned. Layout (little endian, 64 bit
+# arrays 8 byte aligned):
+#   header: magic, number of positions, number of systems, padding
+#   systems * id64, grouped by position in tree order
+#   positions * (x, y, z), in tree order
+#   (positions + 1) * offset of first id64
+spatial_index_magic = b'EDGSPAT2'
+spatial_index_header = struct.Struct('<8sIII')
+spatial_leaf_size = 8
+
+NearbySystem = collections.namedtuple('NearbySystem', 'name system_address distance')
+
+def build_spatial_index(named_systems_file=named_systems_file):
+    with gzip.open(named_systems_file) as f:
+        named_systems = json.load(f)
+    by_position = collections.defaultdict(list)
+    for id64s in named_systems.values():
+        for id64 in (id64s if isinstance(id64s, list) else [id64s]):
+            by_position[tuple(int(x) for x in system_position(id64))].append(id64)
+    positions = list(by_position)
+    stack = [(0, len(positions), 0)]
+    while stack:
+        lo, hi, axis = stack.pop()
+        if hi - lo <= spatial_leaf_size:
+            continue
+        positions[lo:hi] = sorted(positions[lo:hi], key=operator.itemgetter(axis))
+        mid = (lo + hi) // 2
+        stack.append((lo, mid, (axis + 1) % 3))
+        stack.append((mid + 1, hi, (axis + 1) % 3))
+    ids = array.array('Q')
+    coords = array.array('i')
+    offsets = array.array('I', [0])
+    for position in positions:
+        ids.extend(sorted(by_position[position]))
+        coords.extend(position)
+        offsets.append(len(ids))
+    index = bytearray(spatial_index_header.pack(spatial_index_magic, len(positions), len(ids), 0))
+    for a in (ids, coords, offsets):
+        if sys.byteorder != 'little':
+            a.byteswap()
+        index += a.tobytes()
+    return bytes(index)
+
+class SpatialIndex(object):
+    '''
+    Nearest neighbour and radius queries over the positions of named systems,
+    from the memory mapped SpatialIndex.idx, compiled from NamedSystems.json.gz
+    on first use. Queries return (distance, id64) pairs nearest first.
+    '''
+    def __init__(self, named_systems_file=named_systems_file, index_file=spatial_index_file):
+        self.index = open_index(named_systems_file, index_file, spatial_index_magic, build_spatial_index)
+        magic, self.positions, self.count, _ = spatial_index_header.unpack_from(self.index, 0)
+        assert(magic == spatial_index_magic)
+        (self.ids, self.coords, self.offsets), _ = index_sections(self.index, spatial_index_header.size, [
+            ('Q', self.count),
+            ('i', self.positions * 3),
+            ('I', self.positions + 1),
+        ])
+
+    def __len__(self):
+        return self.count
+
+    def _query(self, position, count, limit, exclude):
+        # Walks the tree nearest half first, skipping any half that lies
+        # entirely further away than limit. Once count systems have been
+        # found, limit shrinks to the distance of the furthest of them.
+        # Distances are squared until the end.
+        ids, coords, offsets = self.ids, self.coords, self.offsets
+        px, py, pz = position
+        found = [] # heap of (-distance squared, position number, systems there)
+        systems = 0
+        def visit(i, d2):
+            nonlocal systems, limit
+            n = offsets[i + 1] - offsets[i]
+            if exclude is not None and exclude in ids[offsets[i]:offsets[i + 1]]:
+                n -= 1
+            if not n:
+                return
+            heapq.heappush(found, (-d2, i, n))
+            systems += n
+            if count is None:
+                return
+            # Drop the furthest position while there are enough without it
+            while systems - found[0][2] >= count:
+                systems -= heapq.heappop(found)[2]
+            if systems >= count:
+                limit = -found[0][0]
+        stack = [(0, self.positions, 0, 0.0)]
+        while stack:
+            lo, hi, axis, plane = stack.pop()
+            if plane > limit:
+                continue
+            if hi - lo <= spatial_leaf_size:
+                for i in range(lo, hi):
+                    dx = px - coords[i * 3]
+                    dy = py - coords[i * 3 + 1]
+                    dz = pz - coords[i * 3 + 2]
+                    d2 = dx * dx + dy * dy + dz * dz
+                    if d2 <= limit:
+                        visit(i, d2)
+                continue
+            mid = (lo + hi) // 2
+            dx = px - coords[mid * 3]
+            dy = py - coords[mid * 3 + 1]
+            dz = pz - coords[mid * 3 + 2]
+            d2 = dx * dx + dy * dy + dz * dz
+            if d2 <= limit:
+                visit(mid, d2)
+            diff = dx if axis == 0 else dy if axis == 1 else dz
+            next_axis = (axis + 1) % 3
+            if diff < 0:
+                stack.append((mid + 1, hi, next_axis, diff * diff))
+                stack.append((lo, mid, next_axis, 0.0))
+            else:
+                stack.append((lo, mid, next_axis, diff * diff))
+                stack.append((mid + 1, hi, next_axis, 0.0))
+        matches = sorted((math.sqrt(-d2), id64) for d2, i, n in found
+                for id64 in ids[offsets[i]:offsets[i + 1]] if id64 != exclude)
+        return matches if count is None else matches[:count]
+
+    def nearest(self, position, count=10, max_distance=None, exclude=None):
+        '''
+        The count systems nearest position, optionally only those within
+        max_distance and leaving out the system with id64 exclude
+        '''
+        if count <= 0:
+            return []
+        return self._query(position, count, math.inf if max_distance is None else max_distance ** 2, exclude)
+
+    def within(self, position, radius, exclude=None):
+        return self._query(position, None, radius ** 2, exclude)
+
+class Galaxy(object):
+    '''
+    The data tables edgalmap needs, each loaded on first use so that importing
+    edgalmap performs no I/O and numeric SystemAddress lookups never need to
+    decompress NamedSystems.json.gz. Named systems are loaded into a dict
+    unless compact=True, in which case they are looked up through the
+    memory mapped NamedSystems.idx instead: the first lookup takes a fraction
+    of a millisecond instead of around half a second and memory use is
+    several times lower, but each lookup is around 20us instead of 0.5us.
+    '''
+    def __init__(self, data_dir=data_dir, compact=False):
+        self.sector_lookup_file = os.path.join(data_dir, 'PGSectorNames.json')
+        self.named_systems_file = os.path.join(data_dir, 'NamedSystems.json.gz')
+        self.named_index_file = os.path.join(data_dir, 'NamedSystems.idx')
+        self.search_index_file = os.path.join(data_dir, 'SearchIndex.idx')
+        self.spatial_index_file = os.path.join(data_dir, 'SpatialIndex.idx')
+        self.custom_sectors_file = os.path.join(data_dir, 'CustomSectors.json')
+        self.compact = compact
+        self._sectors = None
+        self._named_systems = None
+        self._named_systems_index = None
+        self._named_systems_by_id64 = None
+        self._named_index = None
+        self._search_index = None
+        self._spatial_index = None
+        self._custom_sectors = None
+
+    @property
+    def sectors(self):
+        if self._sectors is None:
+            # Generated on demand, so there is nothing to load
+            self._sectors = sector_names.ProceduralSectors()
+        return self._sectors
+
+    @property
+    def custom_sectors(self):
+        if self._custom_sectors is None:
+            import custom_sectors
+            with profiling.phase('load CustomSectors.json'):
+                self._custom_sectors = custom_sectors.CustomSectors.load(self.custom_sectors_file)
+        return self._custom_sectors
+
+    @property
+    def named_systems(self):
+        if self._named_systems is None:
+            with profiling.phase('load NamedSystems.json.gz'), gzip.open(self.named_systems_file) as f:
+                self._named_systems = json.load(f)
+        return self._named_systems
+
+    @property
+    def named_systems_index(self):
+        if self._named_systems_index is None:
+            named_systems = self.named_systems
+            with profiling.phase('build named systems index'):
+                self._named_systems_index = build_named_systems_index(named_systems)
+        return self._named_systems_index
+
+    @property
+    def named_index(self):
+        if self._named_index is None:
+            with profiling.phase('load named systems index'):
+                self._named_index = NamedSystemIndex(self.named_systems_file, self.named_index_file)
+        return self._named_index
+
+    @property
+    def search_index(self):
+        if self._search_index is None:
+            with profiling.phase('load search index'):
+                self._search_index = SearchIndex((self.named_systems_file, self.sector_lookup_file), self.search_index_file)
+        return self._search_index
+
+    @property
+    def spatial_index(self):
+        if self._spatial_index is None:
+            with profiling.phase('load spatial index'):
+                self._spatial_index = SpatialIndex(self.named_systems_file, self.spatial_index_file)
+        return self._spatial_index
+
+    def nearby_systems(self, matches):
+        return [NearbySystem(self.lookup_system_name(id64), id64, distance) for distance, id64 in matches]
+
+    def nearest_named_systems(self, position, count=10, max_distance=None, exclude=None):
+        '''
+        The count named systems nearest a galactic position (e.g. from
+        system_position), as a list of NearbySystem nearest first. Distances
+        are between boxel centres, see position_error.
+        '''
+        return self.nearby_systems(self.spatial_index.nearest(position, count, max_distance, exclude))
+
+    def named_systems_within(self, position, radius, exclude=None):
+        return self.nearby_systems(self.spatial_index.within(position, radius, exclude))
+
+    def search(self, query, limit=10, max_distance=search_max_distance):
+        '''
+        Named systems and sectors whose names start with query or are a
+        near miss for it, as a list of SearchMatch
+        '''
+        return [m._replace(id64s=[id64 for name, id64 in self.lookup_named_system(m.name)]) if m.kind == 'system' else m
+                for m in self.search_index.search(query, limit, max_distance)]
+
+    def lookup_named_system(self, system_name):
+        if self.compact:
+            return self.named_index.lookup(system_name)
+        return self.named_systems_index.get(system_name.casefold(), [])
+
+    def lookup_system_name(self, system_address):
+        # Custom name of a system by its SystemAddress (without any BodyID),
+        # or None if it only has a procedural name
+        if self.compact:
+            return self.named_index.name_of(system_address)
+        if self._named_systems_by_id64 is None:
+            self._named_systems_by_id64 = {id64: name for matches in self.named_systems_index.values()
+                    for name, id64 in reversed(matches)}
+        return self._named_systems_by_id64.get(system_address)
+
+galaxy = Galaxy()
+
 def lookup_sector_name(sector_key):
-    return system_lookup_map[sector_key]
+    return galaxy.sectors.name(sector_key)
 def lookup_sector_pos(sector_name):
-    sector_lookup_map = { x['PGN'].strip('\t'): (x['Position']['SectorX'], x['Position']['SectorY'], x['Position']['SectorZ']) for x in system_lookup_json['ProceduralGeneratedSectorNames'] }
-    return sector_lookup_map[sector_name]
+    return galaxy.sectors.position(sector_name)
+def lookup_named_system(system_name):
+    return galaxy.lookup_named_system(system_name)
+def lookup_system_name(system_address):
+    return galaxy.lookup_system_name(system_address)
+def search(query, limit=10, max_distance=search_max_distance):
+    return galaxy.search(query, limit, max_distance)
 
-named_systems = json.load(gzip.open('NamedSystems.json.gz'))
-named_systems_dupe_counts = collections.Counter([k.lower() for k in named_systems.keys()])
-named_systems_dupe_counts += collections.Counter({k.lower(): len(v) for k,v in named_systems.items() if isinstance(v, list)})
-#print(named_systems_dupe_counts.most_common(500))
+def query_position(system):
+    # (position, id64 of the system itself) for a SystemAddress, system name
+    # or (x, y, z) coordinates
+    if isinstance(system, str):
+        messages = []
+        system = resolve(system, log=messages.append).system_address
+        if system is None:
+            # The last thing logged says why
+            raise ValueError(messages[-1])
+    if isinstance(system, int):
+        system &= 2**(64-9)-1
+        return system_position(system), system
+    return tuple(system), None
 
-def s_by_name(system_name, body_id):
-    named_system_count = named_systems_dupe_counts[system_name.lower()]
-    if named_system_count > 1:
-        print('NOTICE: There are multiple systems with this name, try looking up by SystemID instead:')
-        for named_system_name, named_system_id in named_systems.items():
-            if named_system_name.lower() == system_name.lower():
-                if isinstance(named_system_id, list):
-                    for named_system_id_ in named_system_id:
-                        print('"%s": %i' % (named_system_name, named_system_id_))
-                else:
-                    print('"%s": %i' % (named_system_name, named_system_id))
-        return
-    elif named_system_count == 1:
-        for named_system_name, named_system_id in named_systems.items():
-            if named_system_name.lower() == system_name.lower():
-                return s(named_system_id, body_id)
+def nearest_named_systems(system, count=10, max_distance=None):
+    '''
+    The named systems nearest a SystemAddress, system name or (x, y, z)
+    coordinates, not counting the system itself
+    '''
+    position, exclude = query_position(system)
+    return galaxy.nearest_named_systems(position, count, max_distance, exclude)
+
+def named_systems_within(system, radius):
+    position, exclude = query_position(system)
+    return galaxy.named_systems_within(position, radius, exclude)
+
+class AmbiguousSystemName(ValueError):
+    def __init__(self, system_name, matches):
+        ValueError.__init__(self, 'There are multiple systems named "%s"' % system_name)
+        self.matches = matches
+
+# system_name is the procedural name of the system itself, search_string is
+# what to paste into the galaxy map to target the body. system_address and
+# body_address are None if they could not be calculated (e.g. sectors defined
+# by XYZ + radius like Col 69 that custom_sectors.py can't place), custom_name
+# is None unless the system has one.
+Resolved = collections.namedtuple('Resolved', 'system_name search_string system_address body_id body_address custom_name')
+
+def parse_system_name(system_name):
+    '''
+    Split a procedural system name into the (prefix, cube_layer,
+    boxel_remainder, system_id) taken by encode_system_address, where
+    system_id may still have a BodyID folded into it (see b_inv). Raises
+    ValueError if the name is malformed.
+    '''
     prefix, _, suffix = system_name.rpartition(' ')
     if suffix == system_name or suffix[0].lower() not in 'abcdefgh':
-        print('Malformed system name:', suffix)
-        return
+        raise ValueError('Malformed system name: %s' % suffix)
     cube_layer = ord(suffix[0].lower()) - ord('a')
+    boxel_remainder, _, system_id = suffix[1:].rpartition('-')
+    if not system_id.isnumeric() or not (boxel_remainder or '0').isnumeric():
+        raise ValueError('Malformed system ID: %s' % suffix)
+    return (prefix, cube_layer, int(boxel_remainder or 0), int(system_id))
+
+def resolve_name(system_name, body_id=None, log=print):
+    named_matches = lookup_named_system(system_name)
+    if len(named_matches) > 1:
+        raise AmbiguousSystemName(system_name, named_matches)
+    elif named_matches:
+        return resolve_address(named_matches[0][1], body_id, log)
+    system_name = ' '.join(system_name.split())
+    prefix, cube_layer, boxel_remainder, system_id_full = parse_system_name(system_name)
+    suffix = system_name.rpartition(' ')[2]
     if suffix.find('-') == -1:
         suffix = '{}0-{}'.format(suffix[0], suffix[1:])
-        fixed_system_name = '{} {}'.format(system_name.rpartition(' ')[0], suffix)
-        print('NOTE: Added implicit boxel zero remainder to system name: {}'.format(fixed_system_name))
+        fixed_system_name = '{} {}'.format(prefix, suffix)
+        log('NOTE: Added implicit boxel zero remainder to system name: {}'.format(fixed_system_name))
         system_name = fixed_system_name
-    boxel_remainder, _, system_id = suffix[1:].rpartition('-')
-    if not system_id.isnumeric():
-        print('Malformed system ID:', suffix)
-        return
-    system_id_masked, body_id_a = b_inv(cube_layer, int(system_id))
+    system_id = suffix.rpartition('-')[2]
+    system_id_masked, body_id_a = b_inv(cube_layer, system_id_full)
     #print(cube_layer, system_id, system_id_masked, body_id_a)
 
     system_name = system_name[:-len(system_id)] + str((int(system_id) + b(cube_layer, body_id or 0)))
     system_name_a = '{}-{}'.format(system_name.rpartition('-')[0], system_id_masked)
 
     if body_id is not None and body_id_a:
-        print("WARNING: Address already included BodyID %i, replacing with -b %i" % (body_id_a, body_id))
+        log("WARNING: Address already included BodyID %i, replacing with -b %i" % (body_id_a, body_id))
         system_name = '{}-{}'.format(system_name.rpartition('-')[0], system_id_masked + b(cube_layer, body_id))
     elif body_id is None:
         body_id = body_id_a
@@ -101,22 +781,40 @@ def s_by_name(system_name, body_id):
     if body_id_a:
         # Body ID was included in the address cryptically, and we are about to
         # send it to the clipboard cryptically... show the readable ID as well
-        print("%s, Body %i" % (system_name_a, body_id))
+        log("%s, Body %i" % (system_name_a, body_id))
 
     try:
-        system_address = encode_system_address(prefix, cube_layer, int(boxel_remainder), system_id_masked)
+        system_address = encode_system_address(prefix, cube_layer, boxel_remainder, system_id_masked)
         (system_address, body_addr) = calc_body_addr(system_address, body_id)
-        print('System Address: %i' % system_address)
-        print('Body Address: %i' % body_addr)
-    except KeyError:
-        # Probably a sector defined by XYZ + radius (e.g. Col 89) rather than
-        # boxel that we can't look up in the PGSectorNames.json file
-        print('Unable to calculate system address')
+    except KeyError as e:
+        # Probably a sector defined by XYZ + radius (e.g. Col 89) that isn't
+        # in CustomSectors.json, or not well enough known for this cube layer
+        log('Unable to calculate system address: %s' % e.args[0])
+        system_address = body_addr = None
+
+    custom_name = lookup_system_name(system_address) if system_address is not None else None
+    return Resolved(system_name_a, system_name, system_address, body_id, body_addr, custom_name)
+
+def resolve_address(system_address, body_id=None, log=print):
+    (system_name, body_search_string, body_id_a) = resolve_system_address(system_address, body_id, log)
+    (system_address, body_addr) = calc_body_addr(system_address, body_id_a)
+
+    if body_id_a:
+        # Body ID was included in the address cryptically, and we are about to
+        # send it to the clipboard cryptically... show the readable ID as well
+        log("%s, Body %i" % (system_name, body_id_a))
+    return Resolved(system_name, body_search_string, system_address, body_id_a, body_addr,
+            lookup_system_name(system_address))
+
+def resolve(system, body_id=None, log=print):
+    if isinstance(system, str):
+        return resolve_name(system, body_id, log)
+    return resolve_address(system, body_id, log)
 
-    winclipboard.copy_text_simple(system_name.encode('ascii'))
-    print('Copied to clipboard: "%s"' % system_name)
+SystemAddressFields = collections.namedtuple('SystemAddressFields',
+        'cube_layer sector_x sector_y sector_z boxel_x boxel_y boxel_z system_id body_id')
 
-def resolve_system_address(system_address, body_id=None):
+def split_system_address(system_address):
     def get_bits(n):
         return system_address >> n, system_address & 2**n-1
     system_address, cube_layer = get_bits(3)
@@ -132,26 +830,23 @@ def resolve_system_address(system_address, body_id=None):
     system_id_bits = 11 + cube_layer*3
     #print('system_id_bits', system_id_bits)
     system_address, system_id  = get_bits(system_id_bits)
-    system_address, body_id_a  = get_bits(9)
+    system_address, body_id    = get_bits(9)
+    return SystemAddressFields(cube_layer, sector_x, sector_y, sector_z, boxel_x, boxel_y, boxel_z, system_id, body_id)
+
+def resolve_system_address(system_address, body_id=None, log=print):
+    (cube_layer, sector_x, sector_y, sector_z, boxel_x, boxel_y, boxel_z,
+            system_id, body_id_a) = split_system_address(system_address)
     #print('sector', sector_x, sector_y, sector_z)
     #print('boxel', boxel_x, boxel_y, boxel_z)
     #print('system_id', system_id)
     #print('body_id', body_id_a)
     if body_id is not None and body_id_a:
-        print("WARNING: Address already included BodyID %i, replacing with -b %i" % (body_id_a, body_id))
+        log("WARNING: Address already included BodyID %i, replacing with -b %i" % (body_id_a, body_id))
     elif body_id_a:
         body_id = body_id_a
     elif body_id is None:
         body_id = 0
-    try:
-        sector_key = system_lookup_key(sector_x, sector_y, sector_z)
-        sector_name = lookup_sector_name(sector_key).strip('\t')
-    except KeyError as e:
-        print('Sector missing from PGSectorNames.json, please add an entry such as this with PGN filled out:')
-        print('{"Key": %i ,"PGN":"","Position":{"SectorX": %d, "SectorY": %d, "SectorZ": %d}},' % ( \
-            sector_key, sector_x, sector_y, sector_z
-        ))
-        return
+    sector_name = galaxy.sectors.name_at(sector_x, sector_y, sector_z)
     #print('sector', sector_name)
     boxel_key = boxel_x | boxel_y<<7 | boxel_z<<14
     def to_letter(n):
@@ -172,41 +867,58 @@ def resolve_system_address(system_address, body_id=None):
     system_name = '%s%s' % (system_name, system_id)
     return (system_name, body_search_string, body_id)
 
-# NOTE: This function expects the final suffix to have already been decoded by
-# the caller to reduce redundant code
-def encode_system_address(prefix, cube_layer, boxel_remainder, system_id, body_id=0):
-    sector_name, _, boxel_string = prefix.rpartition(' ')
-    sector_x, sector_y, sector_z = lookup_sector_pos(sector_name)
-
+def boxel_position(boxel_string, boxel_remainder):
+    # (boxel_x, boxel_y, boxel_z) from the "AB-C" letters and remainder in a
+    # system name
+    boxel_string = boxel_string.upper()
     def from_letter(n):
         return ord(n) - ord('A')
-    assert(len(boxel_string) == 4)
+    if len(boxel_string) != 4 or boxel_string[2] != '-' or \
+            not all('A' <= c <= 'Z' for c in boxel_string[:2] + boxel_string[3]):
+        raise ValueError('Malformed boxel: %s' % boxel_string)
     boxel_key  = from_letter(boxel_string[0])
     boxel_key += from_letter(boxel_string[1]) * 26
-    assert(boxel_string[2] == '-')
     boxel_key += from_letter(boxel_string[3]) * 26 * 26
     boxel_key += boxel_remainder * 26 * 26 * 26
     boxel_x = (boxel_key      ) & 0x7f
     boxel_y = (boxel_key >>  7) & 0x7f
     boxel_z = (boxel_key >> 14) & 0x7f
-    assert(boxel_key == boxel_x | boxel_y<<7 | boxel_z<<14)
+    if boxel_key != boxel_x | boxel_y<<7 | boxel_z<<14:
+        raise ValueError('Boxel out of range: %s%s' % (boxel_string, boxel_remainder or ''))
     #print('boxel', boxel_key, boxel_x, boxel_y, boxel_z)
+    return (boxel_x, boxel_y, boxel_z)
+
+# NOTE: This function expects the final suffix to have already been decoded by
+# the caller to reduce redundant code
+def encode_system_address(prefix, cube_layer, boxel_remainder, system_id, body_id=0):
+    sector_name, _, boxel_string = prefix.rpartition(' ')
+    boxel_x, boxel_y, boxel_z = boxel_position(boxel_string, boxel_remainder)
+    try:
+        sector_x, sector_y, sector_z = galaxy.sectors.position(sector_name)
+    except KeyError:
+        # Not procedural, but may be a sector defined by XYZ + radius (e.g.
+        # Col 69) whose boxels are counted from its own corner instead
+        (sector_x, sector_y, sector_z, boxel_x, boxel_y, boxel_z) = \
+                galaxy.custom_sectors.locate(sector_name, cube_layer, boxel_x, boxel_y, boxel_z)
 
     boxel_bits = 7 - cube_layer
     system_id_bits = 11 + cube_layer*3
     system_address = 0
-    def put_bits(n, val):
-        assert(val & ~(2**n-1) == 0)
+    def put_bits(n, val, field):
+        # Boxels and system IDs too big for the cube layer come from
+        # malformed names, e.g. "Wregoe AC-D d0-12"
+        if val & ~(2**n-1) != 0:
+            raise ValueError('%s %i out of range for cube layer %s' % (field, val, chr(ord('a') + cube_layer)))
         return system_address << n | val
-    system_address = put_bits(9, body_id)
-    system_address = put_bits(system_id_bits, system_id)
-    system_address = put_bits(7, sector_x)
-    system_address = put_bits(boxel_bits, boxel_x)
-    system_address = put_bits(6, sector_y)
-    system_address = put_bits(boxel_bits, boxel_y)
-    system_address = put_bits(7, sector_z)
-    system_address = put_bits(boxel_bits, boxel_z)
-    system_address = put_bits(3, cube_layer)
+    system_address = put_bits(9, body_id, 'BodyID')
+    system_address = put_bits(system_id_bits, system_id, 'System ID')
+    system_address = put_bits(7, sector_x, 'SectorX')
+    system_address = put_bits(boxel_bits, boxel_x, 'Boxel X')
+    system_address = put_bits(6, sector_y, 'SectorY')
+    system_address = put_bits(boxel_bits, boxel_y, 'Boxel Y')
+    system_address = put_bits(7, sector_z, 'SectorZ')
+    system_address = put_bits(boxel_bits, boxel_z, 'Boxel Z')
+    system_address = put_bits(3, cube_layer, 'Cube layer')
     return system_address
 
 def calc_body_addr(system_addr, body_id):
@@ -215,28 +927,400 @@ def calc_body_addr(system_addr, body_id):
     system_addr = system_addr & (2**(64-9)-1)
     return (system_addr_masked, body_addr)
 
+# Approximate galactic coordinates. A SystemAddress only pins a system down to
+# its boxel, a cube 10ly wide in layer a doubling with each layer up to a whole
+# 1280ly sector in layer h, so positions are given as the centre of the boxel
+# and are within half a boxel of the real position on each axis.
+
+# Coordinates (ly, relative to Sol) of the corner of sector 0, 0, 0
+galaxy_origin = (-49985, -40985, -24105)
+sector_size = 1280
+
+def boxel_size(cube_layer):
+    return sector_size >> (7 - cube_layer)
+
+def position_error(cube_layer):
+    # Furthest a system can be from the centre of its boxel
+    return boxel_size(cube_layer) / 2 * math.sqrt(3)
+
+def system_position(system_address):
+    '''
+    Approximate (x, y, z) galactic coordinates of a system, see
+    position_error for how far out they may be
+    '''
+    fields = split_system_address(system_address)
+    size = boxel_size(fields.cube_layer)
+    return tuple(origin + sector * sector_size + boxel * size + size / 2 for (origin, sector, boxel) in
+            zip(galaxy_origin, fields[1:4], fields[4:7]))
+
+def system_distance(system_address_a, system_address_b):
+    '''
+    Approximate distance in ly between two systems, out by at most the sum of
+    their position_errors
+    '''
+    return math.dist(system_position(system_address_a), system_position(system_address_b))
+
+# Lazy enumeration of procedural systems, for building candidate lists of
+# systems to survey. Nothing is materialised, so these can be run over
+# anything up to whole sectors of layer a systems (2 billion names each).
+
+def sectors_in_range(min_pos, max_pos):
+    # Names of every sector with SectorX/Y/Z within the given inclusive bounds
+    for sector_x in range(min_pos[0], max_pos[0] + 1):
+        for sector_y in range(min_pos[1], max_pos[1] + 1):
+            for sector_z in range(min_pos[2], max_pos[2] + 1):
+                yield galaxy.sectors.name_at(sector_x, sector_y, sector_z)
+
+boxel_letter_pairs = [chr(ord('A') + n % 26) + chr(ord('A') + n // 26) for n in range(26 * 26)]
+
+def iter_boxels(sectors, cube_layer):
+    '''
+    Yields (prefix, system_address) for every boxel of a cube layer (0-7 or
+    'a'-'h') in a sector name or iterable of sector names, where prefix is
+    the procedural name up to the system number (e.g. "Wregoe AC-D d12-")
+    and system_address is that of system 0 in the boxel. Boxels are yielded
+    in order of boxel key.
+    '''
+    if isinstance(sectors, str):
+        sectors = (sectors,)
+    if isinstance(cube_layer, str):
+        cube_layer = ord(cube_layer.lower()) - ord('a')
+    if not 0 <= cube_layer <= 7:
+        raise ValueError('Invalid cube layer')
+    boxel_bits = 7 - cube_layer
+    boxels = 1 << boxel_bits
+    layer_letter = chr(ord('a') + cube_layer)
+    for sector_name in sectors:
+        sector_x, sector_y, sector_z = galaxy.sectors.position(sector_name)
+        sector_name = galaxy.sectors.canonical_name(sector_name)
+        sector_addr = cube_layer \
+                | sector_z << (3 + boxel_bits) \
+                | sector_y << (10 + boxel_bits * 2) \
+                | sector_x << (16 + boxel_bits * 3)
+        for boxel_z in range(boxels):
+            addr_z = sector_addr | boxel_z << 3
+            for boxel_y in range(boxels):
+                addr_y = addr_z | boxel_y << (10 + boxel_bits)
+                for boxel_x in range(boxels):
+                    boxel_key = boxel_x | boxel_y<<7 | boxel_z<<14
+                    boxel_remainder = boxel_key // 26 // 26 // 26
+                    prefix = '%s %s-%s %s' % (sector_name,
+                            boxel_letter_pairs[boxel_key % 676],
+                            chr(ord('A') + boxel_key // 676 % 26),
+                            layer_letter)
+                    if boxel_remainder:
+                        prefix += '%d-' % boxel_remainder
+                    yield (prefix, addr_y | boxel_x << (16 + boxel_bits * 2))
+
+def iter_systems(sectors, cube_layer, max_system_id=None):
+    '''
+    Yields (system_name, system_address) for systems 0 to max_system_id
+    (inclusive, by default every system the layer can address) of every boxel
+    yielded by iter_boxels.
+    '''
+    if isinstance(cube_layer, str):
+        cube_layer = ord(cube_layer.lower()) - ord('a')
+    system_id_bits = 11 + cube_layer * 3
+    if max_system_id is None:
+        max_system_id = (1 << system_id_bits) - 1
+    elif not 0 <= max_system_id < 1 << system_id_bits:
+        raise ValueError('system_id out of range for cube layer')
+    system_ids = [str(x) for x in range(max_system_id + 1)] if max_system_id < 0x10000 else None
+    step = 1 << (23 + (7 - cube_layer) * 3)
+    for prefix, system_address in iter_boxels(sectors, cube_layer):
+        # The system id sits above every other field, so consecutive systems
+        # in a boxel are just consecutive multiples of step apart
+        yield from zip(map(prefix.__add__, system_ids or map(str, range(max_system_id + 1))),
+                range(system_address, system_address + step * (max_system_id + 1), step))
+
+# How many close matches to suggest for names that couldn't be looked up
+suggestions = 5
+
+def print_search_matches(matches):
+    for match in matches:
+        if match.id64s:
+            print('"%s" (%s): %s' % (match.name, match.kind, ', '.join(str(id64) for id64 in match.id64s)))
+        else:
+            print('"%s" (%s)' % (match.name, match.kind))
+
+def print_nearby_systems(nearby):
+    for system in nearby:
+        print('"%s": %i, %.0fly' % (system.name, system.system_address, system.distance))
+
+def print_lookup_error(e, system=None):
+    if isinstance(e, AmbiguousSystemName):
+        print('NOTICE: There are multiple systems with this name, try looking up by SystemID instead:')
+        for named_system_name, named_system_id in e.matches:
+            print('"%s": %i' % (named_system_name, named_system_id))
+    elif isinstance(e, ValueError):
+        print(e)
+        if isinstance(system, str):
+            # Probably a misspelled or incomplete custom name
+            matches = search(system, suggestions)
+            if matches:
+                print('Did you mean:')
+                print_search_matches(matches)
+    elif isinstance(e, KeyError):
+        print(e.args[0])
+
 def s(system_address, body_id=None):
-    if isinstance(system_address, str):
-        return s_by_name(system_address, body_id)
+    try:
+        resolved = resolve(system_address, body_id)
+    except (ValueError, KeyError) as e:
+        print_lookup_error(e, system_address)
+        return
 
-    (system_name, body_search_string, body_id_a) = resolve_system_address(system_address, body_id)
-    (system_address, body_addr) = calc_body_addr(system_address, body_id_a)
+    if resolved.custom_name is not None:
+        print('Named System: %s' % resolved.custom_name)
+    if resolved.system_address is not None:
+        print('System Address: %i' % resolved.system_address)
+        print('Body Address: %i' % resolved.body_address)
+    with profiling.phase('clipboard'):
+        import clipboard
+        clipboard.copy_text(resolved.search_string.encode('ascii'))
+    print('Copied to clipboard: "%s"' % resolved.search_string)
+    return resolved
 
-    if body_id_a:
-        # Body ID was included in the address cryptically, and we are about to
-        # send it to the clipboard cryptically... show the readable ID as well
-        print("%s, Body %i" % (system_name, body_id_a))
-    winclipboard.copy_text_simple(body_search_string.encode('ascii'))
-    print('System Address: %i' % system_address)
-    print('Body Address: %i' % body_addr)
-    print('Copied to clipboard: "%s"' % body_search_string)
+def s_by_name(system_name, body_id):
+    return s(system_name, body_id)
+
+def parse_body_ids(spec, missing=None):
+    # "all", or a comma separated list of BodyIDs and inclusive ranges, e.g.
+    # "9-100" or "3,5,20-30". "missing" stands for the list of BodyIDs passed
+    # in missing, e.g. "missing,9-100".
+    if spec == 'all':
+        return range(512)
+    body_ids = []
+    for part in spec.split(','):
+        if part == 'missing':
+            if missing is None:
+                raise ValueError('missing BodyIDs are not known')
+            body_ids.extend(missing)
+            continue
+        first, sep, last = part.partition('-')
+        body_ids.extend(range(int(first), int(last) + 1) if sep else [int(first)])
+    for body_id in body_ids:
+        if not 0 <= body_id < 512:
+            raise ValueError('BodyID %i out of range, must be between 0 and 511' % body_id)
+    return list(dict.fromkeys(body_ids))
+
+def journal_missing_body_ids(system):
+    # Gaps in the BodyIDs seen in this system according to the journals
+    import journal
+    index = journal.load_index()
+    system_address = index.find(system)
+    if system_address is None and not isinstance(system, int):
+        system_address = resolve(system, log=quiet).system_address
+    if system_address not in index.systems:
+        print('NOTICE: No BodyIDs have been seen in this system in the journals')
+    return index.missing_body_ids(system_address)
+
+def resolve_bodies(system, body_ids, log=print):
+    # Only pass on notes from the first lookup, the rest would just repeat them
+    for i, body_id in enumerate(body_ids):
+        yield resolve(system, body_id, log if i == 0 else quiet)
+
+class clipboard_ui(object):
+    '''
+    Just enough of the ui interface that winclipboard expects to report what
+    is waiting in the clipboard on the console
+    '''
+    @property
+    def mainloop(self):
+        # Only used by the win32 clipboard backend
+        import winclipboard
+        return winclipboard.ui_null()
+    def status(self, msg, append=False):
+        if msg:
+            print(msg)
+
+def bodies(system, body_ids):
+    try:
+        resolved = list(resolve_bodies(system, body_ids))
+    except (ValueError, KeyError) as e:
+        print_lookup_error(e, system)
+        return
+    if not resolved:
+        return
+    if resolved[0].custom_name is not None:
+        print('Named System: %s' % resolved[0].custom_name)
+    for r in resolved:
+        if r.body_address is not None:
+            print('Body %i: "%s" (Body Address: %i)' % (r.body_id, r.search_string, r.body_address))
+        else:
+            print('Body %i: "%s"' % (r.body_id, r.search_string))
+    blobs = [('Body %i' % r.body_id, r.search_string.encode('ascii')) for r in resolved]
+    import clipboard
+    clipboard.get_backend(persistent=True).send_queue(blobs, record=resolved[0].system_name, ui=clipboard_ui())
+    return resolved
+
+# Highest BodyID considered by --watch unless told otherwise with -B, same as
+# find_bodies.sh
+watch_last_body_id = 100
+
+def watch(body_spec=None, journal_dir=None):
+    # Follow the journals, and every time we arrive somewhere or scan
+    # something work out the galaxy map addresses of the bodies we haven't
+    # seen there yet, ready to be queued up with -B
+    import journal
+    for current in journal.watch(journal_dir):
+        with profiling.phase('watch candidates'):
+            missing = current.missing_body_ids()
+            if body_spec:
+                body_ids = parse_body_ids(body_spec, missing)
+            else:
+                body_ids = current.missing_body_ids(watch_last_body_id)
+            resolved = list(resolve_bodies(current.system_address, body_ids, quiet))
+        print()
+        print('Current system: %s' % current.name)
+        print('System Address: %i' % current.system_address)
+        print('Highest bodyID: %s' % max(current.body_ids, default='none'))
+        if not resolved:
+            print('No candidate bodies')
+            continue
+        ranges = journal.format_ranges(journal.missing_ranges(set(range(512)) - set(body_ids), journal.max_body_id))
+        print('%i candidate bodies, first: "%s"' % (len(resolved), resolved[0].search_string))
+        print('    ./edgalmap.py %i -B %s' % (current.system_address, ranges))
+
+batch_fields = ('input',) + Resolved._fields + ('error',)
+
+def read_batch(f):
+    # One system per line, either a SystemAddress or a name, optionally
+    # followed by a tab or comma and a BodyID
+    for line in f:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        body_id = None
+        for sep in '\t,':
+            system, found, body = line.rpartition(sep)
+            if found and body.strip().isnumeric():
+                line, body_id = system.strip(), int(body)
+                break
+        yield (int(line) if line.isnumeric() else line, body_id)
+
+def quiet(*args):
+    pass
+
+def resolve_batch(systems):
+    for system, body_id in systems:
+        row = {'input': system}
+        messages = []
+        try:
+            row.update(resolve(system, body_id, log=messages.append)._asdict())
+            # The last thing logged explains why the address couldn't be
+            # calculated, e.g. a sector custom_sectors.py can't place
+            row['error'] = messages[-1] if row['system_address'] is None else None
+        except (ValueError, KeyError) as e:
+            row.update(dict.fromkeys(Resolved._fields))
+            row['error'] = e.args[0]
+        yield row
+
+def write_batch_csv(results, f):
+    writer = csv.DictWriter(f, batch_fields, lineterminator='\n')
+    writer.writeheader()
+    writer.writerows(results)
+
+def write_batch_jsonl(results, f):
+    for result in results:
+        f.write(json.dumps(result))
+        f.write('\n')
+
+batch_writers = {
+        'csv': write_batch_csv,
+        'jsonl': write_batch_jsonl,
+}
+
+def batch(input_file, output_file, format='csv'):
+    batch_writers[format](resolve_batch(read_batch(input_file)), output_file)
+
+profiled_functions = ['s', 'resolve_name', 'resolve_system_address', 'encode_system_address']
+
+def enable_profiling(cprofile=None):
+    profiling.enable(cprofile)
+    profiling.instrument(sys.modules[__name__], profiled_functions)
+
+profiling.instrument(sys.modules[__name__], profiled_functions)
 
 if __name__ == '__main__':
+    # Only needed once something is copied, so not loaded for library users
+    import clipboard
     parser = argparse.ArgumentParser(description="Warning: Galaxy Map Operating Beyond Safety Limits!")
+    parser.add_argument('--profile', action='store_true', help='Report time and peak memory spent in each phase on exit (or set $EDGALMAP_PROFILE)')
+    parser.add_argument('--profile-output', metavar='FILE', help='Also write cProfile data to FILE, implies --profile')
     parser.add_argument('-b', '--body-id', type=int, default=None, help='BodyID to target')
-    parser.add_argument('system', nargs='+', help='System name (generic names only) or numeric SystemAddress from journal (required for named systems)')
+    parser.add_argument('-B', '--bodies', metavar='IDS', help='Queue up a list of BodyIDs to target, pasted one after another, e.g. "9-100", "3,5,20-30" or "all". "missing" adds any gaps in the BodyIDs seen in the journals, e.g. "missing,9-100"')
+    parser.add_argument('--watch', action='store_true', help='Follow the journals and list the bodies not yet seen in the current system every time it changes (or those given by -B)')
+    parser.add_argument('--clipboard', metavar='BACKEND', choices=sorted(clipboard.backends), help='Clipboard backend to use: %(choices)s (default automatic, or set $EDGALMAP_CLIPBOARD_BACKEND)')
+    parser.add_argument('--search', action='store_true', help='List named systems and sectors starting with or close to the given name, for when the exact name is not known')
+    parser.add_argument('--nearest', action='store_true', help='List the named systems nearest the given system (approximately, by the centre of each boxel)')
+    parser.add_argument('--limit', type=int, default=10, help='Most matches listed by --search or --nearest (default %(default)s)')
+    parser.add_argument('--batch', metavar='FILE', help='Resolve every SystemAddress or system name (optionally followed by a tab or comma and BodyID) listed one per line in FILE ("-" for stdin) without touching the clipboard')
+    parser.add_argument('--format', choices=sorted(batch_writers), default='csv', help='Output format for --batch')
+    parser.add_argument('-o', '--output', metavar='FILE', help='Write --batch results to FILE instead of stdout')
+    parser.add_argument('system', nargs='*', help='System name (generic names only) or numeric SystemAddress from journal (required for named systems)')
     args = parser.parse_args()
+    # A run only looks up a handful of names (or is a batch, where memory
+    # matters more), so isn't worth loading NamedSystems.json.gz for
+    galaxy = Galaxy(compact=True)
+    if args.profile or args.profile_output:
+        enable_profiling(args.profile_output)
+    clipboard.backend_name = args.clipboard
+    if args.batch is not None:
+        input_file = sys.stdin if args.batch == '-' else open(args.batch, 'r')
+        output_file = open(args.output, 'w', newline='') if args.output else sys.stdout
+        with input_file, output_file:
+            batch(input_file, output_file, args.format)
+        sys.exit(0)
+    # Batches never copy anything, so only the rest need the crash log
+    import crash_monitor
+    crash_monitor.enable_copy_log()
+    if args.watch:
+        if args.bodies is not None:
+            try:
+                parse_body_ids(args.bodies, [])
+            except ValueError as e:
+                parser.error('invalid --bodies: %s' % e)
+        try:
+            watch(args.bodies)
+        except KeyboardInterrupt:
+            pass
+        except FileNotFoundError as e:
+            print(e)
+            sys.exit(1)
+        sys.exit(0)
+    if not args.system:
+        parser.error('the following arguments are required: system')
     system = ' '.join(args.system)
+    if args.search:
+        matches = search(system, args.limit)
+        if not matches:
+            print('No matches for "%s"' % system)
+            sys.exit(1)
+        print_search_matches(matches)
+        sys.exit(0)
     if system.isnumeric():
         system = int(system)
-    s(system, args.body_id)
+    if args.nearest:
+        try:
+            nearby = nearest_named_systems(system, args.limit)
+        except (ValueError, KeyError) as e:
+            print_lookup_error(e, system)
+            sys.exit(1)
+        print_nearby_systems(nearby)
+        sys.exit(0)
+    if args.bodies is not None:
+        missing = None
+        if 'missing' in args.bodies.split(','):
+            try:
+                missing = journal_missing_body_ids(system)
+            except (ValueError, KeyError) as e:
+                print_lookup_error(e)
+                sys.exit(1)
+        try:
+            body_ids = parse_body_ids(args.bodies, missing)
+        except ValueError as e:
+            parser.error('invalid --bodies: %s' % e)
+        bodies(system, body_ids)
+    else:
+        s(system, args.body_id)
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+
+# Thin client for edgalmap_server.py. Only needs the standard library modules
+# to talk to the socket, so that a lookup through a running server doesn't
+# pay for loading edgalmap (or even the clipboard unless it copies):
+#
+#   ./edgalmap_client.py Sol -b 21
+#
+# is the same as ./edgalmap_server.py query Sol -b 21
+
+import argparse
+import json
+import os
+import socket
+import sys
+
+if hasattr(socket, 'AF_UNIX') and sys.platform != 'win32':
+    default_address = os.path.expanduser('~/.edgalmap.sock')
+else:
+    default_address = '127.0.0.1:8977'
+
+def parse_address(address):
+    host, sep, port = address.rpartition(':')
+    if sep and port.isnumeric():
+        return (host or '127.0.0.1', int(port))
+    return address
+
+class Client(object):
+    '''
+    Blocking client for the resolver server, sending one JSON request per
+    line and reading back one JSON response per line
+    '''
+    def __init__(self, address=default_address):
+        address = parse_address(address)
+        if isinstance(address, tuple):
+            self.sock = socket.create_connection(address)
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        else:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.connect(address)
+        self.file = self.sock.makefile('rwb')
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def request(self, request):
+        self.file.write(json.dumps(request).encode('utf-8') + b'\n')
+        self.file.flush()
+        return json.loads(self.file.readline())
+
+    def resolve(self, system, body_id=None):
+        return self.request({'op': 'resolve', 'system': system, 'body_id': body_id})
+
+    def body_address(self, system_address, body_id):
+        return self.request({'op': 'body_address', 'system_address': system_address, 'body_id': body_id})
+
+    def search(self, query, limit=10):
+        return self.request({'op': 'search', 'query': query, 'limit': limit})
+
+    def nearest(self, system, count=10, radius=None):
+        return self.request({'op': 'nearest', 'system': system, 'count': count, 'radius': radius})
+
+def add_query_arguments(parser):
+    parser.add_argument('-b', '--body-id', type=int, default=None, help='BodyID to target')
+    parser.add_argument('-n', '--no-clipboard', action='store_true', help='Print the search string instead of copying it to the clipboard')
+    parser.add_argument('system', nargs='+', help='System name or numeric SystemAddress')
+
+def query(args):
+    system = ' '.join(args.system)
+    if system.isnumeric():
+        system = int(system)
+    with Client(args.address) as client:
+        resolved = client.resolve(system, args.body_id)
+    if 'matches' in resolved:
+        print('NOTICE: There are multiple systems with this name, try looking up by SystemID instead:')
+        for named_system_name, named_system_id in resolved['matches']:
+            print('"%s": %i' % (named_system_name, named_system_id))
+        return 1
+    if 'error' in resolved:
+        print(resolved['error'])
+        return 1
+    if resolved.get('custom_name') is not None:
+        print('Named System: %s' % resolved['custom_name'])
+    if resolved['system_address'] is not None:
+        print('System Address: %i' % resolved['system_address'])
+        print('Body Address: %i' % resolved['body_address'])
+    if not args.no_clipboard:
+        import clipboard
+        import crash_monitor
+        crash_monitor.enable_copy_log()
+        clipboard.copy_text(resolved['search_string'].encode('ascii'))
+        print('Copied to clipboard: "%s"' % resolved['search_string'])
+    else:
+        print(resolved['search_string'])
+
+def main():
+    parser = argparse.ArgumentParser(description="Look up a system via a running edgalmap_server.py")
+    parser.add_argument('-a', '--address', default=default_address, help='Unix socket path or [host]:port to connect to (default %(default)s)')
+    add_query_arguments(parser)
+    return query(parser.parse_args())
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+
+# Array level SystemAddress (id64) encoding and decoding, for when there are
+# far too many addresses to push through edgalmap.resolve_system_address one
+# Python int at a time (e.g. every system in a galaxy dump).
+#
+# Bit layout of a SystemAddress, from least significant bit, where
+# boxel_bits = 7 - cube_layer and system_id_bits = 11 + 3 * cube_layer:
+#
+#   cube_layer 3, boxel_z boxel_bits, sector_z 7, boxel_y boxel_bits,
+#   sector_y 6, boxel_x boxel_bits, sector_x 7, system_id system_id_bits,
+#   body_id 9
+#
+# The variable width fields are handled with per element shift amounts looked
+# up from the cube layer, so mixed layer arrays are decoded in a fixed number
+# of whole array passes without needing to group or sort them by layer first.
+#
+# The decoded sector and boxel also give each system's approximate galactic
+# coordinates, so whole arrays of systems can be ranked by distance from a
+# position without a star database (see system_positions and distance_matrix).
+
+import collections
+import numpy as np
+
+import edgalmap
+
+SystemAddressColumns = collections.namedtuple('SystemAddressColumns',
+        'cube_layer sector_x sector_y sector_z boxel_x boxel_y boxel_z system_id body_id')
+
+def _mask(bits):
+    return (np.uint64(1) << bits) - np.uint64(1)
+
+def _field_shifts(cube_layer):
+    boxel_bits = np.uint64(7) - cube_layer
+    return (boxel_bits,
+            np.uint64(3),                      # boxel_z
+            np.uint64(3) + boxel_bits,         # sector_z
+            np.uint64(10) + boxel_bits,        # boxel_y
+            np.uint64(10) + boxel_bits * 2,    # sector_y
+            np.uint64(16) + boxel_bits * 2,    # boxel_x
+            np.uint64(16) + boxel_bits * 3,    # sector_x
+            np.uint64(23) + boxel_bits * 3)    # system_id
+
+def decode_system_addresses(system_addresses):
+    '''
+    Split an array of SystemAddresses into a SystemAddressColumns of uint64
+    arrays, the vectorised equivalent of the field extraction at the top of
+    edgalmap.resolve_system_address.
+    '''
+    a = np.asarray(system_addresses, dtype=np.uint64)
+    cube_layer = a & np.uint64(7)
+    (boxel_bits, boxel_z_shift, sector_z_shift, boxel_y_shift, sector_y_shift,
+            boxel_x_shift, sector_x_shift, system_id_shift) = _field_shifts(cube_layer)
+    boxel_mask = _mask(boxel_bits)
+    system_id_mask = _mask(np.uint64(11) + cube_layer * np.uint64(3))
+    return SystemAddressColumns(
+        cube_layer = cube_layer,
+        sector_x = (a >> sector_x_shift) & np.uint64(0x7f),
+        sector_y = (a >> sector_y_shift) & np.uint64(0x3f),
+        sector_z = (a >> sector_z_shift) & np.uint64(0x7f),
+        boxel_x = (a >> boxel_x_shift) & boxel_mask,
+        boxel_y = (a >> boxel_y_shift) & boxel_mask,
+        boxel_z = (a >> boxel_z_shift) & boxel_mask,
+        system_id = (a >> system_id_shift) & system_id_mask,
+        body_id = a >> np.uint64(55),
+    )
+
+def encode_system_addresses(cube_layer, sector_x, sector_y, sector_z,
+        boxel_x, boxel_y, boxel_z, system_id, body_id=0):
+    '''
+    Inverse of decode_system_addresses. Arguments may be arrays or scalars
+    and are broadcast together. Raises ValueError if any field does not fit
+    in its width for the given cube layer.
+    '''
+    cube_layer = np.asarray(cube_layer, dtype=np.uint64)
+    fields = [np.asarray(x, dtype=np.uint64) for x in
+            (sector_x, sector_y, sector_z, boxel_x, boxel_y, boxel_z, system_id, body_id)]
+    cube_layer, sector_x, sector_y, sector_z, boxel_x, boxel_y, boxel_z, system_id, body_id = \
+            np.broadcast_arrays(cube_layer, *fields)
+    if (cube_layer > 7).any():
+        raise ValueError('Invalid cube layer')
+    (boxel_bits, boxel_z_shift, sector_z_shift, boxel_y_shift, sector_y_shift,
+            boxel_x_shift, sector_x_shift, system_id_shift) = _field_shifts(cube_layer)
+    boxel_mask = _mask(boxel_bits)
+    system_id_mask = _mask(np.uint64(11) + cube_layer * np.uint64(3))
+    for name, val, mask in (
+            ('sector_x', sector_x, np.uint64(0x7f)),
+            ('sector_y', sector_y, np.uint64(0x3f)),
+            ('sector_z', sector_z, np.uint64(0x7f)),
+            ('boxel_x', boxel_x, boxel_mask),
+            ('boxel_y', boxel_y, boxel_mask),
+            ('boxel_z', boxel_z, boxel_mask),
+            ('system_id', system_id, system_id_mask),
+            ('body_id', body_id, np.uint64(0x1ff))):
+        if (val & ~mask).any():
+            raise ValueError('%s out of range for cube layer' % name)
+    return (cube_layer
+            | boxel_z << boxel_z_shift
+            | sector_z << sector_z_shift
+            | boxel_y << boxel_y_shift
+            | sector_y << sector_y_shift
+            | boxel_x << boxel_x_shift
+            | sector_x << sector_x_shift
+            | system_id << system_id_shift
+            | body_id << np.uint64(55))
+
+def sector_keys(columns):
+    '''
+    PGSectorNames.json "Key" for each decoded address, see
+    edgalmap.system_lookup_key
+    '''
+    return columns.sector_x | columns.sector_y << np.uint64(7) | columns.sector_z << np.uint64(14)
+
+def boxel_keys(columns):
+    '''
+    The base 26 boxel key that edgalmap.resolve_system_address turns into the
+    "AB-C a1-" part of a procedural name
+    '''
+    return columns.boxel_x | columns.boxel_y << np.uint64(7) | columns.boxel_z << np.uint64(14)
+
+def boxel_sizes(cube_layer):
+    '''
+    Width in ly of the boxels of each cube layer, see edgalmap.boxel_size
+    '''
+    return np.float64(edgalmap.sector_size) / (np.uint64(1) << (np.uint64(7) - np.asarray(cube_layer, dtype=np.uint64)))
+
+def position_errors(cube_layer):
+    '''
+    Furthest each system can be from its boxel centre, see
+    edgalmap.position_error
+    '''
+    return boxel_sizes(cube_layer) / 2 * np.sqrt(3)
+
+def system_positions(system_addresses):
+    '''
+    Approximate galactic coordinates of an array of SystemAddresses, as an
+    (N, 3) float64 array of x, y, z boxel centres. The vectorised equivalent
+    of edgalmap.system_position.
+    '''
+    columns = system_addresses if isinstance(system_addresses, SystemAddressColumns) \
+            else decode_system_addresses(system_addresses)
+    size = boxel_sizes(columns.cube_layer)
+    sectors = np.stack((columns.sector_x, columns.sector_y, columns.sector_z), axis=-1).astype(np.float64)
+    boxels = np.stack((columns.boxel_x, columns.boxel_y, columns.boxel_z), axis=-1).astype(np.float64)
+    return np.asarray(edgalmap.galaxy_origin, dtype=np.float64) \
+            + sectors * edgalmap.sector_size + (boxels + 0.5) * size[..., np.newaxis]
+
+def distance_matrix(positions_a, positions_b=None):
+    '''
+    (N, M) array of distances between every pair of positions in an (N, 3)
+    and an (M, 3) array, or between every pair within positions_a if
+    positions_b is not given. Pass positions from system_positions, or any
+    known coordinates such as your own.
+    '''
+    a = np.asarray(positions_a, dtype=np.float64)
+    b = a if positions_b is None else np.asarray(positions_b, dtype=np.float64)
+    # One axis at a time, so only an (N, M) array of differences is needed
+    # alongside the result rather than an (N, M, 3) one. Subtracting the
+    # coordinates first keeps the full precision of nearby pairs, which the
+    # |a|^2 + |b|^2 - 2 a.b expansion loses to cancellation this far from
+    # the galactic origin.
+    squared = np.zeros((len(a), len(b)))
+    difference = np.empty_like(squared)
+    for axis in range(a.shape[1]):
+        np.subtract.outer(a[:, axis], b[:, axis], out=difference)
+        difference *= difference
+        squared += difference
+    return np.sqrt(squared, out=squared)
+
+def distances_from(position, positions):
+    '''
+    Distance from one position to each of an (N, 3) array of positions
+    '''
+    return np.sqrt(((np.asarray(positions, dtype=np.float64) - np.asarray(position, dtype=np.float64)) ** 2).sum(axis=-1))
+
+def nearest(position, system_addresses, count=None):
+    '''
+    Indices into system_addresses sorted by approximate distance from
+    position (nearest first), and those distances, optionally only the
+    nearest count of them
+    '''
+    distances = distances_from(position, system_positions(system_addresses))
+    if count is not None and count < len(distances):
+        order = np.argpartition(distances, count)[:count]
+        order = order[np.argsort(distances[order], kind='stable')]
+    else:
+        order = np.argsort(distances, kind='stable')
+    return order, distances[order]
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+
+# Keeps the edgalmap data tables warm in a long running process and answers
+# lookups over a Unix socket (or localhost TCP where those are unavailable),
+# so that scripts probing one body after another don't pay for interpreter
+# startup and data loading on every single lookup.
+#
+# The protocol is one JSON request per line answered by one JSON response per
+# line, and any number of requests may be pipelined on a connection:
+#
+#   {"op": "resolve", "system": "Sol", "body_id": 21}
+#   {"system_name": "Wregoe AC-D d12-0", "search_string": "Wregoe AC-D d12-22020096", ...}
+#
+# A JSON array of requests is answered with a JSON array of responses, which
+# is the cheapest way to push a large batch through in one round trip.
+# Failures are answered with {"error": "..."} rather than closing the
+# connection.
+#
+# The thin client (Client, and the query subcommand) lives in
+# edgalmap_client.py. asyncio and edgalmap are only imported once serving, so
+# that a query doesn't wait for them to load.
+
+import argparse
+import json
+import os
+import sys
+
+from edgalmap_client import default_address, parse_address, add_query_arguments, query
+
+# How often to check whether the data files have been updated (e.g. by
+# update_named_systems.py) and need to be reloaded
+reload_interval = 5.0
+
+# Maximum length of a single request line, large enough for big batches
+max_request_size = 64 * 1024 * 1024
+
+def handle_request(request):
+    op = request.get('op', 'resolve')
+    if op == 'resolve':
+        system = request['system']
+        if isinstance(system, str) and system.isnumeric():
+            system = int(system)
+        return edgalmap.resolve(system, request.get('body_id'), log=edgalmap.quiet)._asdict()
+    elif op == 'encode':
+        return {'system_address': edgalmap.encode_system_address(request['prefix'],
+            request['cube_layer'], request['boxel_remainder'], request['system_id'],
+            request.get('body_id', 0))}
+    elif op == 'body_address':
+        system_address, body_address = edgalmap.calc_body_addr(request['system_address'], request['body_id'])
+        return {'system_address': system_address, 'body_address': body_address}
+    elif op == 'search':
+        return {'matches': [m._asdict() for m in edgalmap.search(request['query'],
+            request.get('limit', 10), request.get('max_distance', edgalmap.search_max_distance))]}
+    elif op == 'nearest':
+        system = request['system']
+        if isinstance(system, str) and system.isnumeric():
+            system = int(system)
+        if request.get('radius') is not None:
+            nearby = edgalmap.named_systems_within(system, request['radius'])
+        else:
+            nearby = edgalmap.nearest_named_systems(system, request.get('count', 10), request.get('max_distance'))
+        return {'systems': [x._asdict() for x in nearby]}
+    elif op == 'ping':
+        return {'pong': True}
+    raise ValueError('Unknown op: %s' % op)
+
+def handle_request_safe(request):
+    try:
+        if not isinstance(request, dict):
+            raise ValueError('Request must be a JSON object')
+        return handle_request(request)
+    except edgalmap.AmbiguousSystemName as e:
+        return {'error': e.args[0], 'matches': e.matches}
+    except KeyError as e:
+        return {'error': 'Not found: %s' % e.args[0]}
+    except (ValueError, TypeError, AssertionError) as e:
+        return {'error': str(e) or e.__class__.__name__}
+
+def import_server_modules():
+    # Deferred until serving, see above
+    global asyncio, edgalmap
+    import asyncio
+    import edgalmap
+
+class Server(object):
+    def __init__(self, data_dir=None):
+        import_server_modules()
+        self.data_dir = data_dir or edgalmap.data_dir
+        edgalmap.galaxy = self.load()
+        self.mtimes = self.data_mtimes()
+
+    def data_mtimes(self):
+        galaxy = edgalmap.galaxy
+        mtimes = []
+        for filename in (galaxy.sector_lookup_file, galaxy.named_systems_file, galaxy.custom_sectors_file):
+            try:
+                mtimes.append(os.stat(filename).st_mtime)
+            except OSError:
+                mtimes.append(None)
+        return mtimes
+
+    def load(self):
+        # Resident for a long time, so keep the memory down
+        galaxy = edgalmap.Galaxy(self.data_dir, compact=True)
+        # Touch every table so the first client doesn't pay for loading them
+        galaxy.sectors
+        galaxy.lookup_named_system('')
+        galaxy.search_index
+        galaxy.spatial_index
+        galaxy.custom_sectors
+        return galaxy
+
+    async def reload_when_changed(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(reload_interval)
+            mtimes = self.data_mtimes()
+            if mtimes == self.mtimes:
+                continue
+            print('Data files changed, reloading...')
+            try:
+                # Keep answering with the old tables while the new ones load
+                galaxy = await loop.run_in_executor(None, self.load)
+            except Exception as e:
+                print('Reload failed, keeping previous data: %s' % e)
+                continue
+            edgalmap.galaxy = galaxy
+            self.mtimes = mtimes
+            print('Reloaded')
+
+    async def handle_client(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                except ValueError as e:
+                    response = {'error': 'Malformed request: %s' % e}
+                else:
+                    if isinstance(request, list):
+                        response = [handle_request_safe(r) for r in request]
+                    else:
+                        response = handle_request_safe(request)
+                writer.write(json.dumps(response).encode('utf-8') + b'\n')
+                await writer.drain()
+        except (ConnectionError, asyncio.LimitOverrunError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, address=default_address):
+        address = parse_address(address)
+        if isinstance(address, tuple):
+            server = await asyncio.start_server(self.handle_client, *address, limit=max_request_size)
+        else:
+            if os.path.exists(address):
+                os.unlink(address)
+            server = await asyncio.start_unix_server(self.handle_client, address, limit=max_request_size)
+        print('Listening on %s' % (address,))
+        asyncio.get_running_loop().create_task(self.reload_when_changed())
+        async with server:
+            await server.serve_forever()
+
+def main():
+    parser = argparse.ArgumentParser(description="Resident edgalmap resolver")
+    parser.add_argument('-a', '--address', default=default_address, help='Unix socket path or [host]:port to listen on / connect to (default %(default)s)')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('serve', help='Run the resolver server')
+    query_parser = subparsers.add_parser('query', help='Look up a system via a running server')
+    add_query_arguments(query_parser)
+    args = parser.parse_args()
+    if args.command == 'serve':
+        try:
+            server = Server()
+            asyncio.run(server.serve(args.address))
+        except KeyboardInterrupt:
+            pass
+    else:
+        return query(args)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -31,22 +31,21 @@ echo Current system: $system_name
 echo System Address: $system_addr
 echo Highest bodyID: $largest_body
 
-# Note: Only searches IDs beyond largest known, which is fine for searching for
-# the new HyperbolicOrbiter as that always seems to be the highest ID, but may
-# miss interesting bodies such as comets if there is a gap in the BodyIDs.
+# Searches IDs beyond largest known, which is fine for searching for the new
+# HyperbolicOrbiter as that always seems to be the highest ID, along with any
+# gaps in the BodyIDs seen in the journals (see journal.py), which may hide
+# interesting bodies such as comets.
 
 test -z "$starting_body" && starting_body=$[ $largest_body + 1 ]
 
-for body_id in $(seq $starting_body 100); do
-   if [ "$use_system_addr" = 1 ]; then
-      cmdline="./edgalmap.py $system_addr -b $body_id"
-   else
-      cmdline="./edgalmap.py $system_name -b $body_id"
-   fi
-   echo
-   echo "$cmdline"
-   $cmdline
-   echo
-   echo Press enter to continue to next body, Ctrl+C to abort...
-   read dummy
-done
+# All candidates are calculated in one go and queued up in the clipboard, so
+# each subsequent paste into the galaxy map targets the next body (or press
+# enter to advance when the clipboard has to be emulated).
+if [ "$use_system_addr" = 1 ]; then
+   cmdline="./edgalmap.py $system_addr -B missing,$starting_body-100"
+else
+   cmdline="./edgalmap.py $system_name -B missing,$starting_body-100"
+fi
+echo
+echo "$cmdline"
+$cmdline
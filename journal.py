@@ -0,0 +1,442 @@
+#!/usr/bin/env python3
+
+# Indexes the player journals (Journal*.log) to find out which BodyIDs have
+# already been seen in each system visited, so that edgalmap can target just
+# the bodies that have not been - including any gaps in the BodyIDs, which
+# find_bodies.sh can't see.
+#
+# The index remembers how far it has read into each journal, so each update
+# only reads what has been appended since the last one. Journals with new data
+# are read in parallel.
+
+import os
+import sys
+import glob
+import time
+import json
+import argparse
+import multiprocessing
+
+import edgalmap
+import profiling
+from common import init_worker, windows_path, read_appended, OffsetIndex
+
+journal_index_filename = 'JournalIndex.json.gz'
+journal_index_file = os.path.join(edgalmap.data_dir, journal_index_filename)
+journal_index_version = 1
+
+# BodyIDs only have 9 bits in a SystemAddress
+max_body_id = 511
+
+def default_journal_dir():
+    journal_dir = os.environ.get('EDGALMAP_JOURNAL_DIR')
+    if journal_dir:
+        return journal_dir
+    user_profile = os.environ.get('USERPROFILE')
+    if not user_profile:
+        return None
+    return windows_path(user_profile + r'\Saved Games\Frontier Developments\Elite Dangerous')
+
+def journal_files(journal_dir):
+    return sorted(glob.glob(os.path.join(glob.escape(journal_dir), 'Journal*.log')))
+
+def latest_journal(journal_dir):
+    # Same as find_bodies.sh: the most recently written journal is the one the
+    # game is writing to
+    files = journal_files(journal_dir)
+    if not files:
+        return None
+    return max(files, key=os.path.getmtime)
+
+def add_event(systems, event):
+    '''
+    Record the system and any BodyIDs mentioned by a journal event in systems,
+    a dict of SystemAddress -> [system name, set of BodyIDs] kept in the
+    order each system was last seen. Returns the SystemAddress, or None if the
+    event doesn't refer to a system.
+    '''
+    system_address = event.get('SystemAddress')
+    if not isinstance(system_address, int):
+        return None
+    system = systems.pop(system_address, None)
+    if system is None:
+        system = [None, set()]
+    systems[system_address] = system
+    name = event.get('StarSystem') or event.get('SystemName')
+    if name:
+        system[0] = name
+    body_id = event.get('BodyID')
+    if isinstance(body_id, int) and 0 <= body_id <= max_body_id:
+        system[1].add(body_id)
+    # Barycentres never get a Scan of their own, they only show up as the
+    # parents of the bodies orbiting them
+    for parent in event.get('Parents') or ():
+        for body_id in parent.values():
+            if isinstance(body_id, int) and 0 <= body_id <= max_body_id:
+                system[1].add(body_id)
+    return system_address
+
+def scan_journal(filename, offset=0):
+    # Runs in the worker processes. Only whole lines are read, as the game may
+    # be half way through writing the last one.
+    systems = {}
+    lines, end = read_appended(filename, offset)
+    for line in lines:
+        if b'"SystemAddress"' not in line:
+            continue
+        try:
+            add_event(systems, json.loads(line))
+        except (ValueError, AttributeError):
+            continue
+    return (filename, end, systems)
+
+def scan_journal_args(args):
+    return scan_journal(*args)
+
+def missing_ranges(body_ids, last=None):
+    '''
+    Inclusive (first, last) ranges of BodyIDs between 0 and the highest in
+    body_ids (or last, if that is higher) that are not in body_ids
+    '''
+    last = max(max(body_ids, default=-1), -1 if last is None else last)
+    ranges = []
+    first = None
+    for body_id in range(last + 1):
+        if body_id in body_ids:
+            if first is not None:
+                ranges.append((first, body_id - 1))
+                first = None
+        elif first is None:
+            first = body_id
+    if first is not None:
+        ranges.append((first, last))
+    return ranges
+
+def format_ranges(ranges):
+    return ','.join('%i' % first if first == last else '%i-%i' % (first, last) for first, last in ranges)
+
+class JournalIndex(OffsetIndex):
+    '''
+    Every system seen in the journals with the BodyIDs seen in it, along with
+    how far each journal has been read.
+    '''
+    version = journal_index_version
+
+    def __init__(self, filename=journal_index_file):
+        OffsetIndex.__init__(self, filename)
+        self.files = {}
+        self.systems = {}
+
+    @classmethod
+    def load(cls, filename=journal_index_file):
+        return super().load(filename)
+
+    def from_json(self, data):
+        self.files = data['files']
+        self.systems = {int(k): [v['name'], set(v['bodies'])] for k, v in data['systems'].items()}
+
+    def to_json(self):
+        return {
+            'files': self.files,
+            'systems': {str(k): {'name': name, 'bodies': sorted(body_ids)}
+                    for k, (name, body_ids) in self.systems.items()},
+        }
+
+    def merge(self, systems):
+        for system_address, (name, body_ids) in systems.items():
+            # Moved to the end, so systems stay in the order last seen
+            system = self.systems.pop(system_address, None)
+            if system is None:
+                self.systems[system_address] = [name, set(body_ids)]
+                continue
+            if name:
+                system[0] = name
+            system[1].update(body_ids)
+            self.systems[system_address] = system
+
+    def update(self, journal_dir, jobs=None):
+        '''
+        Read anything appended to the journals since the last update. Returns
+        the number of bytes read.
+        '''
+        todo = []
+        for filename in journal_files(journal_dir):
+            offset = self.files.get(os.path.basename(filename), 0)
+            size = os.path.getsize(filename)
+            if size < offset:
+                # Journals are only ever appended to, so this is a different
+                # file that happens to have the same name - start over
+                offset = 0
+            if size > offset:
+                todo.append((filename, offset))
+        if not todo:
+            return 0
+        read = 0
+        with profiling.phase('scan journals'):
+            if len(todo) > 1 and jobs != 1:
+                with multiprocessing.Pool(min(jobs or os.cpu_count(), len(todo)), init_worker) as pool:
+                    # In order, so the most recent name of a system wins
+                    results = pool.map(scan_journal_args, todo, chunksize=1)
+            else:
+                results = [scan_journal(*args) for args in todo]
+        offsets = dict(todo)
+        for filename, end, systems in results:
+            read += end - offsets[filename]
+            self.files[os.path.basename(filename)] = end
+            self.merge(systems)
+        profiling.count('journal bytes', read)
+        return read
+
+    def find(self, system):
+        # By SystemAddress or (case insensitive) name, the most recently seen
+        # system wins if the name isn't unique
+        if isinstance(system, int):
+            return system if system in self.systems else None
+        system = system.casefold()
+        for system_address, (name, body_ids) in reversed(self.systems.items()):
+            if name and name.casefold() == system:
+                return system_address
+        return None
+
+    def seen_body_ids(self, system_address):
+        system = self.systems.get(system_address)
+        return system[1] if system else set()
+
+    def highest_body_id(self, system_address):
+        return max(self.seen_body_ids(system_address), default=None)
+
+    def missing_body_ids(self, system_address, last=None):
+        # The gaps below the highest BodyID seen, plus everything above it up
+        # to last if given
+        return [body_id for first, end in missing_ranges(self.seen_body_ids(system_address), last)
+                for body_id in range(first, end + 1)]
+
+def load_index(filename=journal_index_file, journal_dir=None, jobs=None):
+    # Load the index and bring it up to date with the journals, if we can
+    # find them
+    index = JournalIndex.load(filename)
+    journal_dir = journal_dir or default_journal_dir()
+    if journal_dir and os.path.isdir(journal_dir):
+        index.update_and_save(journal_dir, jobs)
+    return index
+
+# How often to check the journals for new entries when inotify isn't
+# available (e.g. Cygwin, or a Windows drive mounted in WSL where inotify never
+# hears about changes made on the Windows side). inotify is also only trusted
+# to wake us early, never to be the only thing that does.
+poll_interval = 0.25
+
+class Inotify(object):
+    '''
+    Minimal ctypes wrapper around the Linux inotify API, watching a directory
+    for files being created or written to
+    '''
+    IN_MODIFY = 0x2
+    IN_CREATE = 0x100
+    IN_MOVED_TO = 0x80
+
+    def __init__(self, directory):
+        import ctypes, ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        if libc.inotify_add_watch(self.fd, os.fsencode(directory),
+                self.IN_MODIFY | self.IN_CREATE | self.IN_MOVED_TO) < 0:
+            os.close(self.fd)
+            raise OSError(ctypes.get_errno(), 'inotify_add_watch failed')
+
+    def wait(self, timeout):
+        import select
+        readable = select.select([self.fd], [], [], timeout)[0]
+        # Drain the queue, we only care that something happened
+        while readable:
+            try:
+                os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+
+    def close(self):
+        os.close(self.fd)
+
+def open_inotify(directory):
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        return Inotify(directory)
+    except (OSError, AttributeError):
+        return None
+
+class JournalTail(object):
+    '''
+    Follows the journal the game is currently writing, returning each new
+    event as it is written and moving on to the next journal when the game
+    starts a new one.
+    '''
+    def __init__(self, journal_dir, filename=None, offset=0):
+        self.journal_dir = journal_dir
+        self.filename = filename or latest_journal(journal_dir)
+        self.offset = offset
+        self.dir_mtime = os.stat(journal_dir).st_mtime_ns
+        self.inotify = open_inotify(journal_dir)
+
+    def close(self):
+        if self.inotify is not None:
+            self.inotify.close()
+            self.inotify = None
+
+    def read_file(self):
+        if self.filename is None:
+            return []
+        try:
+            lines, self.offset = read_appended(self.filename, self.offset)
+        except FileNotFoundError:
+            return []
+        events = []
+        for line in lines:
+            try:
+                events.append(json.loads(line))
+            except ValueError:
+                pass
+        return events
+
+    def read_events(self):
+        # Never blocks. Only looks for a newer journal when the directory has
+        # changed, so idle polling costs two stat calls.
+        events = self.read_file()
+        dir_mtime = os.stat(self.journal_dir).st_mtime_ns
+        if dir_mtime != self.dir_mtime:
+            self.dir_mtime = dir_mtime
+            latest = latest_journal(self.journal_dir)
+            if latest != self.filename:
+                # Finish off the previous journal before starting the new one
+                events += self.read_file()
+                self.filename, self.offset = latest, 0
+                events += self.read_file()
+        return events
+
+    def wait(self, timeout=poll_interval):
+        if self.inotify is not None:
+            self.inotify.wait(timeout)
+        else:
+            time.sleep(timeout)
+
+class CurrentSystem(object):
+    '''
+    Tracks which system we are in and the BodyIDs seen in it from journal
+    events. systems is shared with (and updated like) JournalIndex.systems.
+    '''
+    location_events = ('FSDJump', 'Location', 'CarrierJump')
+
+    def __init__(self, systems=None):
+        self.systems = {} if systems is None else systems
+        self.system_address = None
+
+    def handle(self, event):
+        # Returns True if the current system changed or a new BodyID was seen
+        # in it, not for every event about a body we already know
+        current = self.systems.get(self.system_address)
+        known = len(current[1]) if current else 0
+        system_address = add_event(self.systems, event)
+        if system_address is None:
+            return False
+        if event.get('event') in self.location_events:
+            self.system_address = system_address
+            return True
+        return system_address == self.system_address and len(self.body_ids) > known
+
+    @property
+    def name(self):
+        return self.systems[self.system_address][0]
+
+    @property
+    def body_ids(self):
+        return self.systems[self.system_address][1]
+
+    def missing_body_ids(self, last=None):
+        return [body_id for first, end in missing_ranges(self.body_ids, last)
+                for body_id in range(first, end + 1)]
+
+def watch(journal_dir=None, index_file=journal_index_file):
+    '''
+    Yields a CurrentSystem every time we arrive in a system or something new
+    is found in the current one, starting with wherever we are now. Runs until
+    closed, then saves how far it got into the index.
+    '''
+    journal_dir = journal_dir or default_journal_dir()
+    if not journal_dir or not os.path.isdir(journal_dir):
+        raise FileNotFoundError('Journal directory not found, set $EDGALMAP_JOURNAL_DIR')
+    index = load_index(index_file, journal_dir)
+    current = CurrentSystem(index.systems)
+    tail = JournalTail(journal_dir)
+    try:
+        # Catch up on the current journal once to find out where we are
+        for event in tail.read_events():
+            current.handle(event)
+        if current.system_address is not None:
+            yield current
+        while True:
+            tail.wait()
+            changed = False
+            for event in tail.read_events():
+                changed |= current.handle(event)
+            if changed and current.system_address is not None:
+                yield current
+    finally:
+        tail.close()
+        if tail.filename is not None:
+            index.files[os.path.basename(tail.filename)] = tail.offset
+            try:
+                index.save()
+            except OSError:
+                pass
+
+def main():
+    parser = argparse.ArgumentParser(description='Index the BodyIDs seen in each system in the player journals')
+    parser.add_argument('-d', '--journal-dir', default=default_journal_dir(), help='Journal directory (default %(default)s, or set $EDGALMAP_JOURNAL_DIR)')
+    parser.add_argument('-i', '--index', default=journal_index_file, help='Index file (default %(default)s)')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help='Number of worker processes (default %(default)s)')
+    parser.add_argument('-u', '--upto', type=int, default=None, metavar='ID', help='Also list BodyIDs above the highest seen up to ID')
+    parser.add_argument('--batch', action='store_true', help='List missing BodyIDs one per line as SystemAddress,BodyID, ready for edgalmap.py --batch -')
+    parser.add_argument('--profile', action='store_true', help='Report time spent in each phase on exit')
+    parser.add_argument('--profile-output', metavar='FILE', help='Also write cProfile data to FILE, implies --profile')
+    parser.add_argument('system', nargs='*', help='System name or SystemAddress to list missing BodyIDs for (default every system with any missing)')
+    args = parser.parse_args()
+    if args.profile or args.profile_output:
+        profiling.enable(args.profile_output)
+    if args.upto is not None and not 0 <= args.upto <= max_body_id:
+        parser.error('--upto must be between 0 and %i' % max_body_id)
+    if not args.journal_dir or not os.path.isdir(args.journal_dir):
+        parser.error('journal directory not found, use --journal-dir')
+
+    index = JournalIndex.load(args.index)
+    read = index.update(args.journal_dir, args.jobs)
+    if read:
+        index.save()
+    if not args.batch:
+        print('Read %i bytes of new journal entries, %i systems indexed' % (read, len(index.systems)), file=sys.stderr)
+
+    if args.system:
+        system = ' '.join(args.system)
+        system_address = index.find(int(system) if system.isnumeric() else system)
+        if system_address is None:
+            print('%s not found in the journals' % system, file=sys.stderr)
+            return 1
+        systems = [system_address]
+    else:
+        systems = sorted(index.systems)
+    for system_address in systems:
+        name, body_ids = index.systems[system_address]
+        missing = index.missing_body_ids(system_address, args.upto)
+        if not missing and not args.system:
+            continue
+        if args.batch:
+            for body_id in missing:
+                print('%i,%i' % (system_address, body_id))
+        else:
+            print('%s (%i): highest BodyID %s, missing %s' % (name, system_address,
+                max(body_ids, default='none'), format_ranges(missing_ranges(body_ids, args.upto)) or 'none'))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
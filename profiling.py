@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+
+# Opt-in phase timing for edgalmap and update_named_systems.py, to find out
+# where the time (and memory) goes when something feels slow. Enable it by
+# setting EDGALMAP_PROFILE=1 in the environment, or to a filename to also
+# write out a cProfile dump (viewable with python -m pstats or snakeviz), or
+# with the --profile command line option of either script.
+#
+# Wall time, calls and peak traced memory (via tracemalloc) are reported to
+# stderr on exit for every phase. When profiling is disabled the phase()
+# context manager is close to free and instrument() leaves functions alone,
+# so the hot paths pay nothing for it.
+
+import atexit
+import collections
+import contextlib
+import functools
+import os
+import sys
+import time
+import tracemalloc
+
+enabled = False
+profiler = None
+cprofile_filename = None
+start_time = None
+
+class Phase(object):
+    __slots__ = ('calls', 'time', 'peak')
+    def __init__(self):
+        self.calls = 0
+        self.time = 0.0
+        self.peak = 0
+
+phases = collections.OrderedDict()
+counters = collections.OrderedDict()
+stack = []
+
+def enable(cprofile=None):
+    global enabled, profiler, cprofile_filename, start_time
+    if enabled:
+        return
+    enabled = True
+    start_time = time.perf_counter()
+    tracemalloc.start()
+    # Catches the peak memory of the run as a whole
+    stack.append(['(profiled run)', 0])
+    if cprofile:
+        import cProfile
+        cprofile_filename = cprofile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    atexit.register(report)
+
+def disable_in_worker():
+    # Worker processes forked from a profiled process inherit tracemalloc and
+    # the cProfile hook, which would slow down exactly the work being measured
+    global enabled, profiler
+    enabled = False
+    profiler = None
+    tracemalloc.stop()
+    sys.setprofile(None)
+
+def enable_from_env():
+    value = os.environ.get('EDGALMAP_PROFILE')
+    if value:
+        enable(None if value == '1' else value)
+
+@contextlib.contextmanager
+def phase(name):
+    if not enabled:
+        yield
+        return
+    # tracemalloc only tracks a single peak, so fold it into every enclosing
+    # phase before resetting it for this one
+    peak = tracemalloc.get_traced_memory()[1]
+    for outer in stack:
+        outer[1] = max(outer[1], peak)
+    tracemalloc.reset_peak()
+    frame = [name, 0]
+    stack.append(frame)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        stack.pop()
+        peak = max(frame[1], tracemalloc.get_traced_memory()[1])
+        for outer in stack:
+            outer[1] = max(outer[1], peak)
+        p = phases.get(name)
+        if p is None:
+            p = phases[name] = Phase()
+        p.calls += 1
+        p.time += elapsed
+        p.peak = max(p.peak, peak)
+
+def record(name, seconds):
+    # Time measured by the caller, e.g. on another thread where phase() can't
+    # be used, reported alongside the phases
+    if not enabled:
+        return
+    p = phases.get(name)
+    if p is None:
+        p = phases[name] = Phase()
+    p.calls += 1
+    p.time += seconds
+
+def count(name, n=1):
+    # Throughput counters (e.g. lines or bytes processed), reported as a total
+    # and rate over the profiled run
+    if enabled:
+        counters[name] = counters.get(name, 0) + n
+
+def timed(fn, name=None):
+    name = name or fn.__name__
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        with phase(name):
+            return fn(*args, **kwargs)
+    wrapper.__wrapped__ = fn
+    return wrapper
+
+def instrument(module, names):
+    '''
+    Wrap the named module level functions so each call is timed as a phase.
+    Calls from within the module go through the module globals, so they are
+    timed as well. Does nothing unless profiling has been enabled.
+    '''
+    if not enabled:
+        return
+    for name in names:
+        fn = getattr(module, name)
+        if not hasattr(fn, '__wrapped__'):
+            setattr(module, name, timed(fn, name))
+
+def report(file=None):
+    file = file or sys.stderr
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(cprofile_filename)
+        print('Wrote cProfile data to %s' % cprofile_filename, file=file)
+    total = time.perf_counter() - start_time
+    print('%-36s %8s %12s %12s %12s' % ('phase', 'calls', 'total ms', 'mean us', 'peak KiB'), file=file)
+    for name, p in phases.items():
+        print('%-36s %8i %12.3f %12.1f %12.1f' % (name, p.calls, p.time * 1000.0,
+            p.time / p.calls * 1e6, p.peak / 1024.0), file=file)
+    for name, n in counters.items():
+        print('%-36s %8i total %12.1f/s' % (name, n, n / total if total else 0), file=file)
+    peak = max(stack[0][1], tracemalloc.get_traced_memory()[1])
+    print('%-36s %8s %12.3f %12s %12.1f' % (stack[0][0], '', total * 1000.0, '', peak / 1024.0), file=file)
@@ -0,0 +1,370 @@
+#!/usr/bin/env python3
+
+# Generates the names of procedurally generated sectors from their sector
+# coordinates and back again, so that every sector in the galaxy can be
+# resolved without the PGSectorNames.json lookup table (which only lists the
+# ten thousand or so sectors someone has visited).
+#
+# Names are built from fragments (e.g. "Wr" + "eg" + "oe", or "Eol Prou" from
+# "Eo" + "l" and "Pr" + "ou") picked by walking the sector key through runs of
+# each fragment, following the scheme worked out by the community (EDTS's
+# pgnames.py being the best known implementation). The fragment tables and run
+# lengths below reproduce every one of the 10535 names in PGSectorNames.json,
+# which can be rechecked with:
+#
+#   ./sector_names.py --verify
+#
+# Sectors are identified by the same key as PGSectorNames.json, i.e.
+# SectorX | SectorY << 7 | SectorZ << 14.
+
+import argparse
+import json
+import os
+import sys
+
+# Sector name prefixes, in the order their runs are walked
+prefixes = [
+    'Th', 'Eo', 'Oo', 'Eu', 'Tr', 'Sly', 'Dry', 'Ou',
+    'Tz', 'Phl', 'Ae', 'Sch', 'Hyp', 'Syst', 'Ai', 'Kyl',
+    'Phr', 'Eae', 'Ph', 'Fl', 'Ao', 'Scr', 'Shr', 'Fly',
+    'Pl', 'Fr', 'Au', 'Pry', 'Pr', 'Hyph', 'Py', 'Chr',
+    'Phyl', 'Tyr', 'Bl', 'Cry', 'Gl', 'Br', 'Gr', 'By',
+    'Aae', 'Myc', 'Gyr', 'Ly', 'Myl', 'Lych', 'Myn', 'Ch',
+    'Myr', 'Cl', 'Rh', 'Wh', 'Pyr', 'Cr', 'Syn', 'Str',
+    'Syr', 'Cy', 'Wr', 'Hy', 'My', 'Sty', 'Sc', 'Sph',
+    'Spl', 'A', 'Sh', 'B', 'C', 'D', 'Sk', 'Io',
+    'Dr', 'E', 'Sl', 'F', 'Sm', 'G', 'H', 'I',
+    'Sp', 'J', 'Sq', 'K', 'L', 'Pyth', 'M', 'St',
+    'N', 'O', 'Ny', 'Lyr', 'P', 'Sw', 'Thr', 'Lys',
+    'Q', 'R', 'S', 'T', 'Ea', 'U', 'V', 'W',
+    'Schr', 'X', 'Ee', 'Y', 'Z', 'Ei', 'Oe',
+]
+prefix_run_length = 35
+prefix_run_length_overrides = {
+    'Eu': 31, 'Sly': 4, 'Tz': 1, 'Phl': 13, 'Ae': 12, 'Hyp': 25, 'Kyl': 30,
+    'Phr': 10, 'Eae': 4, 'Ao': 5, 'Scr': 24, 'Shr': 11, 'Fly': 20, 'Pry': 3,
+    'Hyph': 14, 'Py': 12, 'Phyl': 8, 'Tyr': 25, 'Cry': 5, 'Aae': 5, 'Myc': 2,
+    'Gyr': 10, 'Myl': 12, 'Lych': 3, 'Myn': 10, 'Myr': 4, 'Rh': 15, 'Wr': 31,
+    'Sty': 4, 'Spl': 16, 'Sk': 27, 'Sq': 7, 'Pyth': 1, 'Lyr': 10, 'Sw': 24,
+    'Thr': 32, 'Lys': 10, 'Schr': 3, 'Z': 34,
+}
+
+# Infixes follow a prefix (or another infix) ending in the opposite kind of
+# letter: vowel infixes after consonants and consonant infixes after vowels
+vowel_infixes = ['o', 'ai', 'a', 'oi', 'ea', 'ie', 'u', 'e',
+    'ee', 'oo', 'ue', 'i', 'oa', 'au', 'ae', 'oe']
+consonant_infixes = ['ll', 'ss', 'b', 'c', 'd', 'f', 'dg', 'g',
+    'ng', 'h', 'j', 'k', 'l', 'm', 'n', 'mb', 'p', 'q', 'gn', 'th',
+    'r', 's', 't', 'ch', 'tch', 'v', 'w', 'wh', 'ck', 'x', 'y', 'z',
+    'ph', 'sh', 'ct', 'wr']
+# Runs of each infix are as long as the list of suffixes that can follow it
+# unless overridden here
+infix_run_length_overrides = {
+    'oi': 88, 'ue': 147, 'oa': 57, 'au': 119, 'ae': 12, 'oe': 39,
+    'dg': 31, 'tch': 20, 'wr': 31,
+}
+
+# Suffixes ending the name, again the opposite kind to what precedes them.
+# Class 2 sectors only use the first 35 consonant suffixes.
+consonant_suffixes = [
+    'b', 'scs', 'wsy', 'c', 'd', 'vsky', 'f', 'sms', 'dst', 'g', 'rb', 'h',
+    'nts', 'ch', 'rd', 'rld', 'k', 'lls', 'ck', 'rgh', 'l', 'rg', 'm', 'n',
+    'hm', 'p', 'hn', 'rk', 'q', 'rl', 'r', 'rm', 's', 'cs', 'wyg', 'rn', 'ct',
+    't', 'hs', 'rbs', 'rp', 'tts', 'v', 'wn', 'ms', 'w', 'rr', 'mt', 'x', 'rs',
+    'cy', 'y', 'rt', 'z', 'ws', 'lch', 'my', 'ry', 'nks', 'nd', 'sc', 'ng',
+    'sh', 'nk', 'sk', 'nn', 'ds', 'sm', 'sp', 'ns', 'nt', 'dy', 'ss', 'st',
+    'rrs', 'xt', 'nz', 'sy', 'xy', 'rsch', 'rphs', 'sts', 'sys', 'sty', 'th',
+    'tl', 'tls', 'rds', 'nch', 'rns', 'ts', 'wls', 'rnt', 'tt', 'rdy', 'rst',
+    'pps', 'tz', 'tch', 'sks', 'ppy', 'ff', 'sps', 'kh', 'sky', 'ph', 'lts',
+    'wnst', 'rth', 'ths', 'fs', 'pp', 'ft', 'ks', 'pr', 'ps', 'pt', 'fy', 'rts',
+    'ky', 'rshch', 'mly', 'py', 'bb', 'nds', 'wry', 'zz', 'nns', 'ld', 'lf',
+    'gh', 'lks', 'sly', 'lk', 'll', 'rph', 'ln', 'bs', 'rsts', 'gs', 'ls',
+    'vvy', 'lt', 'rks', 'qs', 'rps', 'gy', 'wns', 'lz', 'nth', 'phs',
+]
+vowel_suffixes = [
+    'oe', 'io', 'oea', 'oi', 'aa', 'ua', 'eia', 'ae', 'ooe', 'oo', 'a', 'ue',
+    'ai', 'e', 'iae', 'oae', 'ou', 'uae', 'i', 'ao', 'au', 'o', 'eae', 'u',
+    'aea', 'ia', 'ie', 'eou', 'aei', 'ea', 'uia', 'oa', 'aae', 'eau', 'ee',
+]
+class2_consonant_suffixes = consonant_suffixes[:len(vowel_suffixes)]
+
+# Sector coordinates representable in a SystemAddress
+sector_count = 128 * 64 * 128
+max_sector_key = 127 | 63 << 7 | 127 << 14
+
+# A handful of names repeat in the key space, but never within this many
+# sectors of the galaxy's origin along Z (the galaxy itself ends around 70),
+# so name lookups prefer the lowest SectorZ
+unique_sector_z = 90
+
+def ends_in_vowel(fragment):
+    return fragment[-1].lower() in 'aeiou'
+
+class Runs(object):
+    '''
+    Fragments laid end to end in runs of the given lengths, mapping a count
+    to the fragment whose run it falls in and the offset into that run
+    '''
+    def __init__(self, fragments, lengths):
+        self.fragments = fragments
+        self.lengths = lengths
+        self.starts = []
+        self.total = 0
+        self.entries = []
+        for fragment, length in zip(fragments, lengths):
+            self.starts.append(self.total)
+            self.entries.extend((fragment, offset) for offset in range(length))
+            self.total += length
+        self.index = {fragment.lower(): i for i, fragment in enumerate(fragments)}
+
+    def __getitem__(self, count):
+        return self.entries[count]
+
+    def start(self, fragment):
+        return self.starts[self.index[fragment.lower()]]
+
+    def length(self, fragment):
+        return self.lengths[self.index[fragment.lower()]]
+
+def infix_run_length(infix):
+    default = len(consonant_suffixes) if ends_in_vowel(infix) else len(vowel_suffixes)
+    return infix_run_length_overrides.get(infix, default)
+
+prefix_runs = Runs(prefixes, [prefix_run_length_overrides.get(p, prefix_run_length) for p in prefixes])
+vowel_infix_runs = Runs(vowel_infixes, [infix_run_length(i) for i in vowel_infixes])
+consonant_infix_runs = Runs(consonant_infixes, [infix_run_length(i) for i in consonant_infixes])
+
+def infix_runs(fragment):
+    # Runs of the infixes that can follow fragment
+    return consonant_infix_runs if ends_in_vowel(fragment) else vowel_infix_runs
+
+def suffixes(fragment):
+    # Class 1 suffixes that can follow fragment
+    return consonant_suffixes if ends_in_vowel(fragment) else vowel_suffixes
+
+def class2_suffixes(prefix):
+    return class2_consonant_suffixes if ends_in_vowel(prefix) else vowel_suffixes
+
+def jenkins32(key):
+    # Bob Jenkins' 32 bit integer hash
+    key = (key + (key << 12)) & 0xffffffff
+    key ^= key >> 22
+    key = (key + (key << 4)) & 0xffffffff
+    key ^= key >> 9
+    key = (key + (key << 10)) & 0xffffffff
+    key ^= key >> 2
+    key = (key + (key << 7)) & 0xffffffff
+    key ^= key >> 12
+    return key
+
+def sector_class(sector_key):
+    # Class 1 sectors have one word names (e.g. Wregoe), class 2 two (e.g.
+    # Eol Prou), decided by the hash of the key
+    return 2 if jenkins32(sector_key) & 1 else 1
+
+def class1_fragments(sector_key):
+    cycle, offset = divmod(sector_key, prefix_runs.total)
+    prefix, offset = prefix_runs[offset]
+    # Each level counts how many times it has been around its runs, and that
+    # count times the run length carries on into the next level down
+    runs = infix_runs(prefix)
+    count = cycle * prefix_runs.length(prefix) + offset
+    infix1, offset = runs[count % runs.total]
+    count = count // runs.total * runs.length(infix1) + offset
+    if count < len(suffixes(infix1)):
+        return [prefix, infix1, suffixes(infix1)[count]]
+    runs = infix_runs(infix1)
+    infix2, offset = runs[count % runs.total]
+    return [prefix, infix1, infix2, suffixes(infix2)[offset]]
+
+def class2_word(count):
+    prefix, offset = prefix_runs[count]
+    return prefix + class2_suffixes(prefix)[offset]
+
+def class2_fragments(sector_key):
+    # The even and odd bits of the key each pick a word
+    counts = [0, 0]
+    for bit in range(sector_key.bit_length()):
+        counts[bit & 1] |= (sector_key >> bit & 1) << (bit >> 1)
+    return [class2_word(count) for count in counts]
+
+def sector_name(sector_key):
+    if sector_class(sector_key) == 2:
+        return ' '.join(class2_fragments(sector_key))
+    return ''.join(class1_fragments(sector_key))
+
+def sector_key_pos(sector_key):
+    return (sector_key & 0x7f, sector_key >> 7 & 0x7f, sector_key >> 14 & 0x7f)
+
+def split_fragment(name, fragments):
+    # (fragment, rest of name) for each of fragments name could start with
+    return [(f, name[len(f):]) for f in fragments if name.startswith(f.lower())]
+
+def class2_counts(word):
+    for prefix, suffix in split_fragment(word, prefixes):
+        sfx = class2_suffixes(prefix)
+        if suffix in sfx and sfx.index(suffix) < prefix_runs.length(prefix):
+            yield prefix_runs.start(prefix) + sfx.index(suffix)
+
+def class2_keys(name):
+    words = name.split()
+    if len(words) != 2:
+        return
+    for count0 in class2_counts(words[0]):
+        for count1 in class2_counts(words[1]):
+            sector_key = 0
+            for bit in range(max(count0.bit_length(), count1.bit_length())):
+                sector_key |= (count0 >> bit & 1) << (2 * bit) | (count1 >> bit & 1) << (2 * bit + 1)
+            yield sector_key
+
+def class1_max_count(prefix, infix1):
+    # Highest count class1_fragments can reach at infix1 for any sector key
+    # in a SystemAddress, going by the largest cycle at each level
+    count = max_sector_key // prefix_runs.total * prefix_runs.length(prefix) + prefix_runs.length(prefix) - 1
+    runs = infix_runs(prefix)
+    return count // runs.total * runs.length(infix1) + runs.length(infix1) - 1
+
+def class1_counts(name):
+    # (prefix, infix1, count) for every reading of name, where count is what
+    # class1_fragments derives the suffix (and second infix) from. Names with
+    # a second infix only fix count modulo runs.total, so every count with
+    # that remainder a sector key can reach is a candidate.
+    for prefix, rest in split_fragment(name, prefixes):
+        for infix1, rest in split_fragment(rest, infix_runs(prefix).fragments):
+            sfx = suffixes(infix1)
+            if rest in sfx:
+                yield (prefix, infix1, sfx.index(rest))
+            runs = infix_runs(infix1)
+            for infix2, rest2 in split_fragment(rest, runs.fragments):
+                sfx = suffixes(infix2)
+                if rest2 in sfx and sfx.index(rest2) < runs.length(infix2):
+                    count = runs.start(infix2) + sfx.index(rest2)
+                    while count < len(suffixes(infix1)):
+                        count += runs.total
+                    for count in range(count, class1_max_count(prefix, infix1) + 1, runs.total):
+                        yield (prefix, infix1, count)
+
+def class1_keys(name):
+    if ' ' in name:
+        return
+    for prefix, infix1, count in class1_counts(name):
+        runs = infix_runs(prefix)
+        cycles, offset = divmod(count, runs.length(infix1))
+        count = cycles * runs.total + runs.start(infix1) + offset
+        cycle, offset = divmod(count, prefix_runs.length(prefix))
+        yield cycle * prefix_runs.total + prefix_runs.start(prefix) + offset
+
+def sector_keys(sector_name):
+    '''
+    Every sector key in a SystemAddress's range generating sector_name
+    (ignoring case and whitespace), lowest SectorZ first
+    '''
+    name = ' '.join(sector_name.split()).lower()
+    keys = set()
+    for sector_key in list(class1_keys(name)) + list(class2_keys(name)):
+        if sector_key < 1 << 21 and sector_key >> 7 & 0x7f < 64 and \
+                sector_name_lower(sector_key) == name:
+            keys.add(sector_key)
+    return sorted(keys, key=lambda k: (k >> 14, k))
+
+def sector_name_lower(sector_key):
+    return sector_name(sector_key).lower()
+
+class ProceduralSectors(object):
+    '''
+    Bidirectional sector key <-> name <-> position lookups, generated rather
+    than looked up. Name lookups ignore case and whitespace.
+    '''
+    def __init__(self):
+        # Bulk lookups (e.g. a whole galaxy dump) keep hitting the same few
+        # thousand sectors, so remember the answers
+        self.names = {}
+        self.keys = {}
+
+    def __len__(self):
+        return sector_count
+
+    def name(self, sector_key):
+        name = self.names.get(sector_key)
+        if name is None:
+            if not 0 <= sector_key < 1 << 21 or sector_key >> 7 & 0x7f >= 64:
+                raise KeyError(sector_key)
+            name = self.names[sector_key] = sector_name(sector_key)
+        return name
+
+    def name_at(self, sector_x, sector_y, sector_z):
+        return self.name(sector_x | sector_y << 7 | sector_z << 14)
+
+    def key(self, sector_name):
+        key = self.keys.get(sector_name)
+        if key is None:
+            keys = sector_keys(sector_name)
+            if not keys or keys[0] >> 14 > unique_sector_z:
+                # Misses aren't remembered, as there is no end to names that
+                # aren't procedural. Custom sectors like Col 69 Sector are
+                # looked up here first, but having more words than any
+                # procedural name they are turned away in a few us anyway.
+                raise KeyError(sector_name)
+            key = self.keys[sector_name] = keys[0]
+        return key
+
+    def position(self, sector_name):
+        return sector_key_pos(self.key(sector_name))
+
+    def canonical_name(self, sector_name):
+        return self.name(self.key(sector_name))
+
+    def __iter__(self):
+        for sector_z in range(128):
+            for sector_y in range(64):
+                for sector_x in range(128):
+                    key = sector_x | sector_y << 7 | sector_z << 14
+                    yield (key, self.name(key), (sector_x, sector_y, sector_z))
+
+def verify(json_file):
+    '''
+    Check names and keys both ways against every sector in PGSectorNames.json
+    '''
+    sectors = json.load(open(json_file, 'r'), strict=False)['ProceduralGeneratedSectorNames']
+    mismatches = 0
+    for sector in sectors:
+        key, name = sector['Key'], sector['PGN'].strip('\t')
+        generated = sector_name(key)
+        keys = sector_keys(name)
+        if generated != name or keys[:1] != [key]:
+            mismatches += 1
+            print('%i "%s": generated "%s", keys %s' % (key, name, generated, keys))
+    print('%i of %i sectors match' % (len(sectors) - mismatches, len(sectors)))
+    return mismatches
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate procedural sector names')
+    parser.add_argument('--verify', metavar='FILE', nargs='?', const=os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), 'PGSectorNames.json'),
+        help='Check the generator against every sector in PGSectorNames.json (or FILE)')
+    parser.add_argument('sector', nargs='*', help='Sector name, key, or SectorX SectorY SectorZ')
+    args = parser.parse_args()
+    if args.verify:
+        return 1 if verify(args.verify) else 0
+    if not args.sector:
+        parser.error('the following arguments are required: sector')
+    sectors = ProceduralSectors()
+    try:
+        if all(x.isnumeric() for x in args.sector) and len(args.sector) in (1, 3):
+            if len(args.sector) == 3:
+                sector_x, sector_y, sector_z = map(int, args.sector)
+                key = sector_x | sector_y << 7 | sector_z << 14
+            else:
+                key = int(args.sector[0])
+            name = sectors.name(key)
+        else:
+            name = ' '.join(args.sector)
+            key = sectors.key(name)
+            name = sectors.name(key)
+    except KeyError:
+        print('Not a procedural sector: %s' % ' '.join(args.sector))
+        return 1
+    print('%s: Key %i, Position %s, Class %i' % (name, key, sector_key_pos(key), sector_class(key)))
+
+if __name__ == '__main__':
+    sys.exit(main())
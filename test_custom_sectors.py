@@ -0,0 +1,67 @@
+import gzip
+import json
+import math
+import random
+
+import edgalmap
+import custom_sectors
+
+# Nowhere near Col 69, the one sector CustomSectors.json was learned from
+centre = [-1234.5, 67.25, 2890.75]
+radius = 85.0
+
+def system_address(position, cube_layer, system_id):
+    boxel_bits = 7 - cube_layer
+    size = edgalmap.boxel_size(cube_layer)
+    x, y, z = (math.floor((p - o) / size) for p, o in zip(position, edgalmap.galaxy_origin))
+    mask = (1 << boxel_bits) - 1
+    return cube_layer \
+            | (z & mask) << 3 | (z >> boxel_bits) << (3 + boxel_bits) \
+            | (y & mask) << (10 + boxel_bits) | (y >> boxel_bits) << (10 + boxel_bits * 2) \
+            | (x & mask) << (16 + boxel_bits * 2) | (x >> boxel_bits) << (16 + boxel_bits * 3) \
+            | system_id << (23 + boxel_bits * 3)
+
+def random_position(rng):
+    while True:
+        offset = [rng.uniform(-radius, radius) for axis in range(3)]
+        if math.hypot(*offset) <= radius:
+            return [c + x for c, x in zip(centre, offset)]
+
+def test_encode_decode_by_centre_and_radius(monkeypatch):
+    sector = custom_sectors.CustomSector('Test Sector', centre, radius)
+    sectors = custom_sectors.CustomSectors([sector], filename=None)
+    monkeypatch.setattr(edgalmap.galaxy, '_custom_sectors', sectors)
+    rng = random.Random(69)
+    for cube_layer in range(8):
+        for i in range(20):
+            address = system_address(random_position(rng), cube_layer, rng.randrange(100))
+            position = edgalmap.system_position(address)
+            if not sector.contains(position):
+                # Boxel centre outside the sphere, so it isn't named after it
+                continue
+            name, = sectors.system_names(address)
+            assert name.startswith('Test Sector ')
+            assert edgalmap.resolve(name, log=lambda *args: None).system_address == address
+
+def test_learn_dump_fits_centre_and_radius(tmp_path):
+    rng = random.Random(89)
+    truth = custom_sectors.CustomSectors([custom_sectors.CustomSector('Test Sector', centre, radius)])
+    dump = tmp_path / 'systems.json.gz'
+    with gzip.open(dump, 'wt') as f:
+        f.write('[\n')
+        f.write('{"id64":10477373803,"name":"Sol","coords":{"x":0,"y":0,"z":0}},\n')
+        for i in range(2000):
+            position = random_position(rng)
+            address = system_address(position, rng.choice((0, 0, 1, 2)), i)
+            for name in truth.system_names(address):
+                f.write(json.dumps({'id64': address, 'name': name,
+                    'coords': dict(zip('xyz', position))}) + ',\n')
+        f.write(']\n')
+    sectors = custom_sectors.CustomSectors(filename=None)
+    assert custom_sectors.learn_dump(sectors, dump, jobs=1) == 1
+    sector = sectors.get('test sector')
+    assert sector.known_layers() == list(range(8))
+    assert math.dist(sector.centre, centre) < 3
+    assert abs(sector.radius - radius) < 3
+    for cube_layer in range(8):
+        assert sector.origin(cube_layer) == truth.get('Test Sector').origin(cube_layer)
@@ -0,0 +1,17 @@
+import journal
+
+def test_duplicate_body_event_is_not_a_change():
+    current = journal.CurrentSystem()
+    assert current.handle({'event': 'FSDJump', 'StarSystem': 'Sol', 'SystemAddress': 10477373803})
+    scan = {'event': 'Scan', 'SystemAddress': 10477373803, 'BodyID': 3, 'Parents': [{'Star': 0}]}
+    assert current.handle(scan)
+    assert current.body_ids == {0, 3}
+    # The same body again (e.g. a detailed surface scan) finds nothing new
+    assert not current.handle(scan)
+    assert not current.handle({'event': 'FSSBodySignals', 'SystemAddress': 10477373803, 'BodyID': 0})
+    assert current.handle({'event': 'Scan', 'SystemAddress': 10477373803, 'BodyID': 5})
+
+def test_bodies_in_other_systems_are_not_a_change():
+    current = journal.CurrentSystem()
+    current.handle({'event': 'Location', 'StarSystem': 'Sol', 'SystemAddress': 10477373803})
+    assert not current.handle({'event': 'Scan', 'SystemAddress': 1327473756, 'BodyID': 17})
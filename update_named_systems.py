@@ -3,10 +3,31 @@
 import os
 import gzip
 import json
-import itertools
+import time
+import signal
+import argparse
+import datetime
+import collections
+import multiprocessing
+
+import edgalmap
+import profiling
+from common import init_worker
 
 systems_filename = 'systems.json.gz'
 named_systems_filename = 'NamedSystems.json.gz'
+named_index_filename = 'NamedSystems.idx'
+
+# Size of the blocks of decompressed lines handed to each worker process
+chunk_size = 16 * 1024 * 1024
+
+# Seconds between progress reports
+progress_interval = 10
+
+# Checkpoint the partial results after this many lines so that an
+# interrupted or crashed run can be resumed with --resume
+save_interval_lines = 0x1000000
+checkpoint_filename = 'NamedSystems.checkpoint.json.gz'
 #sector_lookup_file = 'PGSectorNames.json'
 #system_lookup_json = json.load(open(sector_lookup_file, 'r'), strict=False)
 #procedural_sectors = { x['PGN'].strip('\t') for x in system_lookup_json['ProceduralGeneratedSectorNames'] }
@@ -50,17 +71,34 @@ def is_procedural_name(system_name):
     # the list of custom sector names (omicron bot on the Indenedent Raxxla
     # Hunters discord definitely had the list before it got shut down) first,
     # and for now hope the above tests are sufficient to catch all custom
-    # system names.
+    # system names. In the meantime custom_sectors.py places custom sectors
+    # from systems whose SystemAddress is known (e.g. from the journals).
     #return sector_name in procedural_sectors
     return True
 
-def process_line(line):
-    global result
-    j = json.loads(line.rstrip(b',\n'))
-    name = j['name']
-    if is_procedural_name(name):
-        return
-    id64 = j['id64']
+def filter_chunk(chunk, delta=False):
+    # Runs in the worker processes: parse a block of whole lines from the dump
+    # and return only the systems with custom names, along with the number of
+    # lines processed for the progress report. When merging a delta we also
+    # need to know which systems now have procedural names, in case they have
+    # lost a custom name we already had
+    named = []
+    procedural = []
+    lines = chunk.split(b'\n')
+    for line in lines:
+        line = line.rstrip(b',\r')
+        if not line or line in (b'[', b']'):
+            continue
+        j = json.loads(line)
+        name = j['name']
+        if is_procedural_name(name):
+            if delta:
+                procedural.append(j['id64'])
+            continue
+        named.append((name, j['id64']))
+    return named, procedural, len(lines) - 1
+
+def add_system(name, id64):
     #print('%i: %s' % (id64, name))
     if name in result:
         # XXX: Need to understand duplicate names better, e.g. there are four
@@ -75,41 +113,232 @@ def process_line(line):
     else:
         result[name] = id64
 
+def remove_system(name, id64):
+    if isinstance(result[name], list):
+        result[name].remove(id64)
+        if len(result[name]) == 1:
+            result[name] = result[name][0]
+    else:
+        del result[name]
+
+class Delta(object):
+    '''
+    Merges an incremental dump (e.g. Spansh's systems_1day.json.gz) into the
+    existing results, only touching systems that are new or have been renamed.
+    '''
+    def __init__(self):
+        self.names = {}
+        for name, id64s in result.items():
+            for id64 in (id64s if isinstance(id64s, list) else [id64s]):
+                self.names[id64] = name
+        self.added = self.renamed = self.removed = 0
+
+    def merge(self, named, procedural):
+        for name, id64 in named:
+            old_name = self.names.get(id64)
+            if old_name == name:
+                continue
+            if old_name is None:
+                self.added += 1
+            else:
+                print('NOTICE: System %i renamed from "%s" to "%s"' % (id64, old_name, name))
+                remove_system(old_name, id64)
+                self.renamed += 1
+            add_system(name, id64)
+            self.names[id64] = name
+        for id64 in procedural:
+            old_name = self.names.pop(id64, None)
+            if old_name is not None:
+                print('NOTICE: System %i "%s" no longer has a custom name' % (id64, old_name))
+                remove_system(old_name, id64)
+                self.removed += 1
+
+    def report(self):
+        print('%i systems added, %i renamed, %i removed' % (self.added, self.renamed, self.removed))
+
+def read_chunks(f, size=chunk_size):
+    # Cut the decompressed stream into large blocks that end on a line
+    # boundary so they can be handed to the workers independently. Also
+    # yields the uncompressed offset just past each block for checkpointing.
+    offset = f.tell()
+    remainder = b''
+    while True:
+        with profiling.phase('decompress'):
+            data = f.read(size)
+        if not data:
+            break
+        profiling.count('uncompressed bytes', len(data))
+        data = remainder + data
+        cut = data.rfind(b'\n') + 1
+        remainder = data[cut:]
+        if cut:
+            offset += cut
+            yield offset, data[:cut]
+    if remainder:
+        yield offset + len(remainder), remainder + b'\n'
+
 def save_results():
-    with gzip.open(named_systems_filename, 'wt') as output_file:
+    with profiling.phase('save results'), gzip.open(named_systems_filename, 'wt') as output_file:
         json.dump(result, output_file, sort_keys=True, indent=1)
     print("Wrote", named_systems_filename)
+    # Compile the index edgalmap actually reads now, rather than have the
+    # first lookup pay for it
+    with profiling.phase('save results index'), open(named_index_filename, 'wb') as f:
+        f.write(edgalmap.build_named_index(named_systems_filename))
+    print("Wrote", named_index_filename)
+
+def load_results():
+    global result
+    with gzip.open(named_systems_filename, 'rt') as f:
+        result = json.load(f)
+
+def dump_identity(dump):
+    s = os.stat(dump)
+    return [os.path.abspath(dump), s.st_size, s.st_mtime]
+
+def save_checkpoint(dump, delta, offset, lines):
+    # Unlike save_results this skips sorting, indenting and heavy compression
+    # since it is written often and only ever read back by --resume
+    checkpoint = {
+        'dump': dump_identity(dump),
+        'delta': delta,
+        'offset': offset,
+        'lines': lines,
+        'result': result,
+    }
+    tmp_filename = checkpoint_filename + '.tmp'
+    with profiling.phase('save checkpoint'), gzip.open(tmp_filename, 'wt', compresslevel=1) as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp_filename, checkpoint_filename)
+
+def load_checkpoint(dump):
+    global result
+    with gzip.open(checkpoint_filename, 'rt') as f:
+        checkpoint = json.load(f)
+    if checkpoint['dump'] != dump_identity(dump):
+        raise ValueError('%s was made from a different dump (%s)' % (checkpoint_filename, checkpoint['dump'][0]))
+    result = checkpoint['result']
+    return checkpoint
+
+class Progress(object):
+    def __init__(self, f, filesize, lines=0):
+        self.f = f
+        self.filesize = filesize
+        self.start = self.last = time.time()
+        self.start_pos = f.fileobj.tell()
+        self.start_lines = self.lines = lines
+
+    def update(self, lines):
+        self.lines += lines
+        now = time.time()
+        if now - self.last < progress_interval:
+            return
+        self.last = now
+        elapsed = now - self.start
+        pos = self.f.fileobj.tell()
+        rate = (pos - self.start_pos) / elapsed
+        eta = (self.filesize - pos) / rate if rate else 0
+        print('%.2f%% %i lines (%i lines/s, %.1f MB/s compressed) %i named, ETA %s' % (
+            pos / self.filesize * 100.0, self.lines, (self.lines - self.start_lines) / elapsed,
+            rate / 1e6, len(result), datetime.timedelta(seconds=int(eta))))
 
 def main():
-    if not os.path.isfile(systems_filename):
+    parser = argparse.ArgumentParser(description='Rebuild %s from the Spansh galaxy dump' % named_systems_filename)
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help='Number of worker processes (default %(default)s)')
+    parser.add_argument('-r', '--resume', action='store_true', help='Resume an interrupted run from %s' % checkpoint_filename)
+    parser.add_argument('-d', '--delta', action='store_true', help='Merge new and renamed systems from an incremental dump (e.g. systems_1day.json.gz) into the existing %s instead of rebuilding it' % named_systems_filename)
+    parser.add_argument('--profile', action='store_true', help='Report time spent in each phase and lines/bytes per second on exit (or set $EDGALMAP_PROFILE)')
+    parser.add_argument('--profile-output', metavar='FILE', help='Also write cProfile data for the main process to FILE, implies --profile')
+    parser.add_argument('dump', nargs='?', default=systems_filename, help='Spansh systems dump (default %(default)s)')
+    args = parser.parse_args()
+    if args.profile or args.profile_output:
+        profiling.enable(args.profile_output)
+    else:
+        profiling.enable_from_env()
+
+    if not os.path.isfile(args.dump):
         print('Please save https://downloads.spansh.co.uk/systems.json.gz to this directory')
         return
 
-    s = os.stat(systems_filename)
+    s = os.stat(args.dump)
     filesize = s.st_size
 
+    offset = lines = 0
+    if args.resume:
+        checkpoint = load_checkpoint(args.dump)
+        offset, lines, args.delta = checkpoint['offset'], checkpoint['lines'], checkpoint['delta']
+        print('Resuming from line %i with %i named systems' % (lines, len(result)))
+    elif args.delta:
+        load_results()
+    delta = Delta() if args.delta else None
+
+    pool = multiprocessing.Pool(args.jobs, init_worker)
+    # Only act on Ctrl+C between blocks, so that the results and offset in the
+    # checkpoint always agree with each other
+    interrupted = []
+    signal.signal(signal.SIGINT, lambda signum, frame: interrupted.append(signum))
+    progress = None
     try:
-        with gzip.open(systems_filename) as f:
+        with gzip.open(args.dump) as f:
+            # gzip can't jump straight to an offset in the middle of the
+            # stream, but decompressing up to it is still a great deal faster
+            # than parsing the json we already have the results for
+            f.seek(offset)
             # Reading such a large json file all at once is not a great idea,
-            # parse + filter one line at a time instead
-            assert(f.readline() == b'[\n')
-            for i in itertools.count():
-                if i and not i & 0xfffff:
-                    print('%.2f%% %i' % (f.fileobj.tell() / filesize * 100.0, len(result)))
-                    if not i & 0xffffff:
-                        save_results()
-                line = f.readline()
-                if line == b']\n': # EOF
-                    break
-                process_line(line)
+            # have the pool parse + filter it in large blocks of lines instead,
+            # with a bounded number of blocks in flight to limit memory usage
+            progress = Progress(f, filesize, lines)
+            pending = collections.deque()
+            lines_since_save = 0
+            def merge(job):
+                nonlocal lines_since_save, offset
+                chunk_offset, job = job
+                with profiling.phase('wait for workers'):
+                    named, procedural, lines = job.get()
+                with profiling.phase('merge'):
+                    if delta is not None:
+                        delta.merge(named, procedural)
+                    else:
+                        for name, id64 in named:
+                            add_system(name, id64)
+                profiling.count('lines', lines)
+                offset = chunk_offset
+                progress.update(lines)
+                lines_since_save += lines
+                if lines_since_save >= save_interval_lines:
+                    lines_since_save = 0
+                    save_checkpoint(args.dump, args.delta, offset, progress.lines)
+            for chunk_offset, chunk in read_chunks(f):
+                if interrupted:
+                    raise KeyboardInterrupt()
+                pending.append((chunk_offset, pool.apply_async(filter_chunk, (chunk, args.delta))))
+                if len(pending) >= args.jobs * 2:
+                    merge(pending.popleft())
+            while pending:
+                if interrupted:
+                    raise KeyboardInterrupt()
+                merge(pending.popleft())
+            profiling.count('compressed bytes', f.fileobj.tell())
     except KeyboardInterrupt:
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        pool.terminate()
+        save_checkpoint(args.dump, args.delta, offset, progress.lines if progress else lines)
+        print('Wrote %s, continue later with --resume' % checkpoint_filename)
         r = ''
         while not r or r.lower() not in 'yn':
             r = input("Interrupted, save partial results? (y/n)")
         if r.lower() != 'y':
             return
+        save_results()
+        return
+    finally:
+        pool.terminate()
 
+    if delta is not None:
+        delta.report()
     save_results()
+    if os.path.exists(checkpoint_filename):
+        os.remove(checkpoint_filename)
 
 if __name__ == '__main__':
     main()
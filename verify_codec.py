@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+
+# Checks edgalmap's SystemAddress codec against every system in the Spansh
+# galaxy dump: each id64 is decoded to a procedural name, and each procedural
+# name is encoded back to an id64, and anything that doesn't agree with the
+# dump is reported along with statistics for each cube layer. Worth running
+# whenever the data files are refreshed.
+
+import os
+import sys
+import gzip
+import json
+import time
+import signal
+import argparse
+import collections
+import multiprocessing
+
+import edgalmap
+import profiling
+import update_named_systems
+from common import init_worker
+
+# Mismatches of each kind kept per block of the dump for the report
+max_examples = 10
+
+# Most sectors listed in the report, the rest are only in the --output file
+max_listed_sectors = 50
+
+# Every id64 is decoded. Those of procedural systems must decode to their
+# name, while named systems only have to decode to a procedural name that
+# encodes back to the same id64. custom counts the procedural looking names
+# in sectors defined by XYZ + radius (e.g. Col 69), which are checked like
+# named systems, and also against custom_sectors.py's names for the id64 when
+# it knows the centre and radius of their sector
+layer_stats = ('systems', 'procedural', 'named', 'custom', 'decoded', 'decode_mismatch',
+        'encoded', 'encode_mismatch', 'unencodable')
+
+class Results(object):
+    def __init__(self):
+        self.layers = [collections.Counter() for i in range(8)]
+        # sector name -> systems, for procedural names we couldn't encode
+        # (e.g. sectors defined by XYZ + radius like Col 69 that
+        # custom_sectors.py can't place)
+        self.unencodable_sectors = collections.Counter()
+        self.examples = collections.defaultdict(list)
+        self.systems = 0
+
+    def example(self, kind, *args):
+        if len(self.examples[kind]) < max_examples:
+            self.examples[kind].append(args)
+
+    def merge(self, other):
+        for layer, counter in zip(self.layers, other.layers):
+            layer.update(counter)
+        self.unencodable_sectors.update(other.unencodable_sectors)
+        for kind, examples in other.examples.items():
+            self.examples[kind].extend(examples[:max_examples - len(self.examples[kind])])
+        self.systems += other.systems
+
+    def mismatches(self):
+        return sum(layer['decode_mismatch'] + layer['encode_mismatch'] for layer in self.layers)
+
+def encode_name(name):
+    prefix, cube_layer, boxel_remainder, system_id = edgalmap.parse_system_name(name)
+    return edgalmap.encode_system_address(prefix, cube_layer, boxel_remainder, system_id)
+
+def verify_system(results, id64, name):
+    fields = edgalmap.split_system_address(id64)
+    stats = results.layers[fields.cube_layer]
+    stats['systems'] += 1
+    procedural = update_named_systems.is_procedural_name(name)
+    stats['procedural' if procedural else 'named'] += 1
+    custom = False
+    if procedural:
+        try:
+            edgalmap.galaxy.sectors.key(name.rpartition(' ')[0].rpartition(' ')[0])
+        except KeyError:
+            custom = True
+            stats['custom'] += 1
+
+    # Every id64 is decoded to its position and procedural name, whatever
+    # the system is called
+    try:
+        edgalmap.system_position(id64)
+        decoded = edgalmap.resolve_system_address(id64, log=edgalmap.quiet)[0]
+    except (KeyError, ValueError) as e:
+        stats['decode_mismatch'] += 1
+        results.example('decode', id64, name, str(e) or e.__class__.__name__)
+        return
+    stats['decoded'] += 1
+    if procedural and not custom:
+        if decoded != name:
+            stats['decode_mismatch'] += 1
+            results.example('decode', id64, name, decoded)
+    else:
+        # Named and custom sector systems go by another name, but the
+        # procedural one must still lead back to the same id64
+        try:
+            encoded = encode_name(decoded)
+        except (KeyError, ValueError) as e:
+            encoded = str(e) or e.__class__.__name__
+        if encoded != id64:
+            stats['decode_mismatch'] += 1
+            results.example('decode', id64, name, '%s -> %s' % (decoded, encoded))
+            return
+        if custom:
+            try:
+                names = edgalmap.galaxy.custom_sectors.system_names(id64)
+            except KeyError:
+                # A containing sector isn't known well enough for this cube layer
+                names = None
+            if names and name not in names:
+                stats['decode_mismatch'] += 1
+                results.example('decode', id64, name, ', '.join(names))
+
+    if not procedural:
+        return
+    try:
+        encoded = encode_name(name)
+    except KeyError:
+        stats['unencodable'] += 1
+        results.unencodable_sectors[name.rpartition(' ')[0].rpartition(' ')[0]] += 1
+        return
+    except (ValueError, AssertionError) as e:
+        # The name looked procedural but isn't quite (e.g. a system ID too
+        # big for its cube layer)
+        stats['encode_mismatch'] += 1
+        results.example('encode', id64, name, str(e) or e.__class__.__name__)
+        return
+    stats['encoded'] += 1
+    if encoded != id64:
+        stats['encode_mismatch'] += 1
+        results.example('encode', id64, name, encoded)
+
+def verify_chunk(chunk):
+    # Runs in the worker processes
+    results = Results()
+    lines = chunk.split(b'\n')
+    for line in lines:
+        line = line.rstrip(b',\r')
+        if not line or line in (b'[', b']'):
+            continue
+        j = json.loads(line)
+        verify_system(results, j['id64'], j['name'])
+        results.systems += 1
+    return results
+
+def report(results, elapsed, file=sys.stdout):
+    print('%i systems in %.1fs (%i systems/s)' % (results.systems, elapsed,
+        results.systems / elapsed if elapsed else 0), file=file)
+    print('%-6s' % 'layer' + ''.join(' %15s' % x for x in layer_stats), file=file)
+    totals = collections.Counter()
+    for cube_layer, stats in enumerate(results.layers):
+        totals.update(stats)
+        print('%-6s' % chr(ord('a') + cube_layer) + ''.join(' %15i' % stats[x] for x in layer_stats), file=file)
+    print('%-6s' % 'total' + ''.join(' %15i' % totals[x] for x in layer_stats), file=file)
+    if results.unencodable_sectors:
+        print('\n%i sectors with procedural looking names that could not be encoded:' %
+                len(results.unencodable_sectors), file=file)
+        for sector_name, systems in results.unencodable_sectors.most_common(max_listed_sectors):
+            print('%s (%i systems)' % (sector_name, systems), file=file)
+    if len(results.unencodable_sectors) > max_listed_sectors:
+        print('\nOnly the %i sectors with the most systems listed, use --output for the rest' % max_listed_sectors, file=file)
+    for kind, examples in sorted(results.examples.items()):
+        print('\n%s mismatches (first %i):' % (kind.capitalize(), len(examples)), file=file)
+        for id64, name, got in examples:
+            print('%i "%s" -> %s' % (id64, name, got), file=file)
+
+def results_json(results, elapsed):
+    return {
+        'systems': results.systems,
+        'elapsed_s': elapsed,
+        'layers': {chr(ord('a') + i): dict(stats) for i, stats in enumerate(results.layers)},
+        'unencodable_sectors': dict(results.unencodable_sectors),
+        'examples': {kind: [list(x) for x in examples] for kind, examples in results.examples.items()},
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Verify the SystemAddress codec against every system in the Spansh dump')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help='Number of worker processes (default %(default)s)')
+    parser.add_argument('-o', '--output', metavar='FILE', help='Also write the results as JSON to FILE')
+    parser.add_argument('--profile', action='store_true', help='Report time spent in each phase on exit')
+    parser.add_argument('--profile-output', metavar='FILE', help='Also write cProfile data for the main process to FILE, implies --profile')
+    parser.add_argument('dump', nargs='?', default=update_named_systems.systems_filename, help='Spansh systems dump (default %(default)s)')
+    args = parser.parse_args()
+    if args.profile or args.profile_output:
+        profiling.enable(args.profile_output)
+    if not os.path.isfile(args.dump):
+        print('Please save https://downloads.spansh.co.uk/systems.json.gz to this directory')
+        return 2
+
+    results = Results()
+    start = last_progress = time.time()
+    pool = multiprocessing.Pool(args.jobs, init_worker)
+    interrupted = []
+    signal.signal(signal.SIGINT, lambda signum, frame: interrupted.append(signum))
+    try:
+        with gzip.open(args.dump) as f:
+            pending = collections.deque()
+            def merge(job):
+                nonlocal last_progress
+                with profiling.phase('wait for workers'):
+                    chunk_results = job.get()
+                results.merge(chunk_results)
+                profiling.count('systems', chunk_results.systems)
+                now = time.time()
+                if now - last_progress >= update_named_systems.progress_interval:
+                    last_progress = now
+                    print('%i systems (%i systems/s), %i mismatches so far' % (results.systems,
+                        results.systems / (now - start), results.mismatches()), file=sys.stderr)
+            for chunk_offset, chunk in update_named_systems.read_chunks(f):
+                if interrupted:
+                    break
+                pending.append(pool.apply_async(verify_chunk, (chunk,)))
+                if len(pending) >= args.jobs * 2:
+                    merge(pending.popleft())
+            while pending and not interrupted:
+                merge(pending.popleft())
+    finally:
+        pool.terminate()
+    if interrupted:
+        print('Interrupted, results so far:')
+
+    elapsed = time.time() - start
+    report(results, elapsed)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results_json(results, elapsed), f, indent=1)
+    return 1 if results.mismatches() else 0
+
+if __name__ == '__main__':
+    sys.exit(main())